@@ -3,19 +3,12 @@ update_photonotes
 create and update personal photonotes in and from Evernote
 """
 
-import os
 import sys
 
 import logging
+from update_photonotes.log_config import setup_logging
 
-if os.getenv('DEBUG') == '1':
-    LOG_FORMAT = "%(asctime)-15s %(name)s %(levelname)-8s %(message)s"
-    LOG_DATE_FORMAT = "%dT%H:%M:%S"
-else:
-    LOG_FORMAT = "%(levelname)-8s %(message)s"
-    LOG_DATE_FORMAT = "%H:%M:%S"
-LOGLEVEL = os.getenv("LOGLEVEL", logging.INFO)
-logging.basicConfig(level=LOGLEVEL, format=LOG_FORMAT, datefmt=LOG_DATE_FORMAT)
+setup_logging()
 logger = logging.getLogger('app.main')
 
 
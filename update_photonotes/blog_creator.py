@@ -1,14 +1,12 @@
 """
 Create a blog note for given Flickr blog URL
 
-costs: 7 API calls
+costs: 5 API calls
   flickr.urls.lookupUser: 1
-  flickr.people.getPhotos: 1
-  flickr.photos.getInfo: 1
+  flickr.people.getPhotos: 1  (dates and size urls of recent photo passed as extras)
   flickr.people.getInfo: 1
   flickr.photosets.getList: 1
   flickr.galleries.getList: 1
-  flickr.photos.getSizes: 1
 
 """
 
@@ -17,12 +15,9 @@ from types import SimpleNamespace
 
 import os
 import json
-import base64
 import datetime
-import re
-from io import StringIO
 from pathlib import Path
-import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from lxml import etree
 
@@ -34,13 +29,22 @@ import flickr_api
 from flickr_api.objects import Photo, Person
 from . import flickr_utils
 
-import requests
-import requests_cache  # usefulness for flickr API? looks like Flicker prenvents caching
-
 
 import logging
 logger = logging.getLogger('create_blog')
 
+# number of Flickr API calls to run concurrently for a blog note - one worker per getter
+# (recent photo thumbnail, description, albums, galleries), see create_blog_note
+MAX_WORKERS = 4
+
+# extras for recent photo, so that no flickr.photos.getInfo / getSizes is needed
+# note: flickr_api parses url_* extras into photo sizes only if media is requested as well
+RECENT_PHOTO_EXTRAS = 'date_taken,date_upload,media,url_t,url_s,url_m,url_l,url_o'
+
+# precompiled xpath expressions to clean up user description
+PHOTO_CONTAINER_XPATH = etree.XPath("//span[contains(@class, 'photo_container')]")
+IMG_XPATH = etree.XPath("//img")
+
 
 class BlogCreator:
 
@@ -69,60 +73,50 @@ class BlogCreator:
         self.output_path = self.base_path / "import"
         self.output_path.mkdir(exist_ok=True)
 
-        date_created = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
-        self.params = {
-            'note_created': date_created,
-            'note_updated': date_created,
-            'today': datetime.date.today().isoformat(),
-            'timestamp': datetime.datetime.now().isoformat()[:16],
-        }
+        self.params = {}
         flickr_utils.authenticate(use_auth_session=options.use_auth_session)
-        if os.environ.get('REQUESTS_CACHE') != "1":
-            # no caching, but create a session
-            self.session = requests.session()
-        else:
-            # cache as much as we can to reduce number of API calls
-            self.session = requests_cache.CachedSession('note_creator', expire_after=datetime.timedelta(days=6))
-            requests_cache.install_cache('note_creator')
-            # note: need to cache POST requests, what is not by default
-
-        self.api_cache = flickr_utils.CountingAPIcallsCache(
+        # cache as much as we can to reduce number of API calls if REQUESTS_CACHE=1
+        self.session = flickr_utils.create_session(use_cache=os.environ.get('REQUESTS_CACHE') == "1")
+
+        # cache API calls in memory, if API_CACHE=1 persist them so that reruns for same blog
+        # do not hit Flickr again
+        api_cache_dir = self.base_path / "__cache"
+        api_cache_dir.mkdir(exist_ok=True)
+        self.api_cache = flickr_utils.create_api_cache(
+                api_cache_dir / "flickr_api_cache.db",
+                persist=os.environ.get('API_CACHE') == "1",
                 timeout=3600 * 12,  # 12 hours
                 max_entries=1000,
         )
         # defaults are: timeout=300, max_entries=200
         # len(self.api_cache) is number of entries in cache
-        flickr_api.enable_cache(
-            self.api_cache
-        )
+        # note: enabled for flickr_api while creating a note only, see route_api_calls
 
     def get_recent_photo(self, user: Person) -> tuple:
-        photo = user.getPhotos(page=1)[0]
-        last_taken = photo.taken
+        photo = user.getPhotos(page=1, per_page=1, extras=RECENT_PHOTO_EXTRAS)[0]
+        # note: use .get to access extras, attribute access would load photo info if missing
+        last_taken = photo.get('datetaken')
         if last_taken:
             if len(last_taken) > 10:
                 last_taken = last_taken[:10]  # date only
         else:
             last_taken = str(last_taken)
-        if photo.takenunknown == '1':
+        if photo.get('datetakenunknown') == '1':
             last_taken = "?" + last_taken
 
         self.params["last_taken"] = last_taken
-        last_upload = datetime.datetime.fromtimestamp(int(photo.dateuploaded)).isoformat()[:10]
+        last_upload = flickr_utils.format_timestamp(photo.get('dateupload'))
         self.params["last_upload"] = last_upload
         return photo, last_taken, last_upload
 
-    def from_template(self, template, params, encoding='utf-8'):
-        data = template.read_text(encoding=encoding)
-        for key in params:
-            data = data.replace(f'${{{key}}}', str(params[key]))
-
-        match = re.search(r'\${(.*?)}', data)
-        if match:
-            logger.warning("detected placeholders in template not replaced: %s" % match.group(1))
-        return data
+    def get_recent_photo_thumbnail(self, user: Person, blog_id: str) -> tuple:
+        """ get recent photo and fetch its thumbnail for blog note """
+        photo, last_taken, last_upload = self.get_recent_photo(user)
+        self.fetch_blog_thumbnail(blog_id, photo)
+        return photo, last_taken, last_upload
 
     def pick_photo_size(self, photo: Photo, acceptable: tuple) -> dict:
+        # sizes from url_* extras, flickr.photos.getSizes is called only if missing
         sizes = photo.getSizes()
         for s_key in acceptable:
             s_item = sizes.get(s_key)
@@ -146,25 +140,24 @@ class BlogCreator:
 
         # save thumbnail image
         img_file = self.output_path / img_key
-        # response = self.session.get(url=s_item["source"])  # unreliable
         if not img_file.is_file():
-            img_file_s = photo.save(str(img_file), s_item['label'])
-            logger.info(f"saved image for blog thumbnail: {img_file_s}")
+            # download through session, photo.save would call flickr.photos.getSizes again
+            response = self.session.get(s_item["source"])
+            response.raise_for_status()
+            img_data_raw = response.content
+            img_file.write_bytes(img_data_raw)
+            logger.info(f"saved image for blog thumbnail: {img_file}")
         else:
             # use cached image - useful while debugging to reduce api calls
             logger.debug(f"use cached image for blog thumbnail: {img_file}")
+            img_data_raw = img_file.read_bytes()
 
         self.params['preview_fn'] = img_key
-        img_data_raw = img_file.read_bytes()
-        img_data = base64.b64encode(img_data_raw).decode()
-        self.params['filehash'] = hashlib.md5(img_data_raw).hexdigest()
+        img_data, self.params['filehash'] = utils.encode_resource(img_data_raw)
         self.params['preview_width'] = s_item['width']
         self.params['preview_height'] = s_item['height']
         self.params['mimetype'] = utils.get_mimetype(Path(img_key).suffix)
 
-        # ensure base64 padding
-        while len(img_data) % 4 != 0:
-            img_data += '='
         self.params['resource_data'] = img_data
         return
 
@@ -173,23 +166,23 @@ class BlogCreator:
         description = utils.get_safe_property(user, "description", None)
         if description:
             description = description.replace('\n', '<br/>')
-            parser = etree.HTMLParser()
-            tree = etree.parse(StringIO(description), parser)
+            # note: keep lxml, need XHTML serialization for note content (ENML)
+            root = etree.HTML(description)
             # drop all photo_container items from description
-            for item in tree.xpath("//span[contains(@class, 'photo_container')]"):
+            for item in PHOTO_CONTAINER_XPATH(root):
                 item.getparent().remove(item)
-            body = tree.find("./body")
+            body = root.find("body")
             utils.drop_empty_tags(body, "div")
-            for item in body.xpath("//img"):
+            for item in IMG_XPATH(body):
                 # drop layzloading (and other) images
                 item.getparent().remove(item)
 
-            # extract html fragment from body
+            # extract html fragment from body, i.e. strip enclosing body element
             html = etree.tostring(body, pretty_print=True).decode('utf-8')
-            match = re.search('<body>(.*?)</body>', html, re.DOTALL)
-            if match:
-                fragment = match.group(1)
+            if html.startswith('<body>'):
+                fragment = html[len('<body>'):html.rfind('</body>')]
             else:
+                # empty body, serialized as <body/>
                 fragment= "(no description found)"
             user_description = fragment
 
@@ -222,6 +215,16 @@ class BlogCreator:
         #     LOGGER.warning(f"found places: {len(places)}")
         return
 
+    def format_gallery(self, photo_count: int, gal_item) -> str:
+        """ format gallery info as list item """
+        gal_title = utils.quote_xml(gal_item['title'])
+        # .id, .description, .count_total, .count_views, .url
+        gal_id = gal_item["gallery_id"]
+        created = flickr_utils.format_timestamp(gal_item['date_create'])
+        updated = flickr_utils.format_timestamp(gal_item['date_update'])
+        count_photos = f"{photo_count:,}".replace(',', '.')
+        return f"<li>{gal_title} | {gal_id} | #={count_photos} c={created} u={updated}</li>"
+
     def get_galleries(self, user: Person, extra_tags: list) -> None:
         """ get list of galleries of user """
         galleries = []
@@ -229,24 +232,21 @@ class BlogCreator:
             galleries.append((gal_item.get('count_photos', 0), gal_item))
 
         galleries.sort(reverse=True, key=lambda value: value[0])
-        gal_items = []
-        for photo_count, gal_item in galleries:
-            gal_title = utils.quote_xml(utils.quote_xml(gal_item['title']))
-            # .id, .description, .count_total, .count_views, .url
-            gal_id = gal_item["gallery_id"]
-            created = datetime.datetime.fromtimestamp(int(gal_item['date_create'])).isoformat()[:10]
-            updated = datetime.datetime.fromtimestamp(int(gal_item['date_update'])).isoformat()[:10]
-            count_photos = f"{photo_count:,}".replace(',', '.')
-            gal_info = f"{gal_title} | {gal_id} | #={count_photos} c={created} u={updated}"
-            gal_items.append(f"<li>{gal_info}</li>")
-
-        if gal_items:
+        if galleries:
             extra_tags.append("blog_galleries")
-            self.params['gallery_list'] = "<ul>%s</ul>" % "\n".join(gal_items)
+            gal_items = "\n".join(self.format_gallery(photo_count, gal_item) for photo_count, gal_item in galleries)
+            self.params['gallery_list'] = f"<ul>{gal_items}</ul>"
         else:
             self.params['gallery_list'] = "<div><span>No galleries</span></div>"
         return
 
+    def format_album(self, photo_count: int, album) -> str:
+        """ format album info as list item """
+        album_title = utils.quote_xml(album.title)
+        updated = flickr_utils.format_timestamp(album.date_update)
+        count_photos = f"{photo_count:,}".replace(',', '.')
+        return f"<li>{album_title} | #={count_photos} u={updated}</li>"
+
     def get_albums(self, user: Person) -> None:
         """ get list of albums for user """
         self.params['albums_list'] = ''
@@ -260,23 +260,31 @@ class BlogCreator:
         albums_list.sort(reverse=True, key=lambda value: value[0])
 
         # and generate list of albums
-        album_items = []
-        for photo_count, album in albums_list:
-            album_title = utils.quote_xml(album.title)
-            updated = datetime.datetime.fromtimestamp(int(album.date_update)).isoformat()[:10]
-            count_photos = f"{photo_count:,}".replace(',', '.')
-            album_info = f"{album_title} | #={count_photos} u={updated}"
-            album_items.append(f"<li>{album_info}</li>")
-
-        if album_items:
-            self.params['albums_list'] = "<ul>%s</ul>" % "\n".join(album_items)
+        if albums_list:
+            album_items = "\n".join(self.format_album(photo_count, album) for photo_count, album in albums_list)
+            self.params['albums_list'] = f"<ul>{album_items}</ul>"
         else:
             self.params['albums_list'] = "<div><span>No albums</span></div>"
         return
 
     def create_note(self, flickr_url: str) -> bool:
+        # route API calls through self.session and self.api_cache only while creating the note, as
+        # NoteCreator may be used in the same run with its own session and cache
+        with flickr_utils.route_api_calls(self.session, self.api_cache):
+            return self.create_blog_note(flickr_url)
+
+    def create_blog_note(self, flickr_url: str) -> bool:
         logger.info(f"create blognote for {flickr_url}")
         assert flickr_url.startswith('https://www.flickr.com/people/'), "must have a Flickr URL to a blog entry"
+
+        # initialize parameters for .enex and .xml templates, BlogCreator may be used for more than one note
+        date_created = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+        self.params = {
+            'note_created': date_created,
+            'note_updated': date_created,
+            'today': datetime.date.today().isoformat(),
+            'timestamp': datetime.datetime.now().isoformat()[:16],
+        }
         steps = flickr_url.split('/')
         blog_id = steps[4]
         # note: using spaces in filename allowes easier picking of photo id from Windows Explorer
@@ -286,30 +294,47 @@ class BlogCreator:
         enex_path.with_suffix('.txt').write_text(flickr_url)
 
         extra_tags = []  # FUTURE auto-generate tags from user info
-        now_date = datetime.datetime.now().strftime('%Y-%m-%d')
-        data_path = self.blog_path / blog_id
-        data_path.mkdir(exist_ok=True)
-        user_data = data_path / f"user_{blog_id}.{now_date}.json"
 
         user = flickr_api.Person.findByUrl(flickr_url)
         if not user:
             raise ValueError(f"user not found by url={flickr_url}")
 
-        user_data.write_text(json.dumps(user.__dict__, indent=4, default=str), encoding='utf-8')
-        # user_info = SimpleNamespace(**json.loads(user_data.read_text()))
+        # load user info (flickr.people.getInfo) before running the getters concurrently,
+        # otherwise each of them would trigger lazy loading of the Person object on its own
+        user.load()
+        if self._options.debug:
+            # dump user info for examination, only when debugging
+            now_date = datetime.datetime.now().strftime('%Y-%m-%d')
+            data_path = self.blog_path / blog_id
+            data_path.mkdir(exist_ok=True)
+            user_data = data_path / f"user_{blog_id}.{now_date}.json"
+            user_data.write_text(json.dumps(user.__dict__, indent=4, default=str), encoding='utf-8')
+            # user_info = SimpleNamespace(**json.loads(user_data.read_text()))
         logger.info(f"lookup by url succeeded, user for {blog_id} is {user.id} / {user.username}")
 
+        # the getters are independent of each other and update disjoint keys in self.params,
+        # so run them concurrently - wall-clock time is dominated by Flickr API latency
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # thumbnail depends on recent photo only, so download it overlapping with the other getters
+            recent_photo = executor.submit(self.get_recent_photo_thumbnail, user, blog_id)
+            getters = [
+                recent_photo,
+                executor.submit(self.get_description, user),
+                executor.submit(self.get_albums, user),
+                executor.submit(self.get_galleries, user, extra_tags),
+            ]
+            for getter in as_completed(getters):
+                getter.result()  # surface exceptions raised in getter
+
         # summary for user / blog
         now = datetime.date.today().isoformat()
-        photo, last_taken, last_upload = self.get_recent_photo(user)
+        photo, last_taken, last_upload = recent_photo.result()
         count_photos = f"{user.photos_info.get('count', 0):,}".replace(',', '.')
         if last_taken:
             blog_info = f"{now}: #={count_photos},  t={last_taken},  u={last_upload}"
         else:
             blog_info = f"{now}: #={count_photos},  u={last_upload}"
 
-        self.get_description(user)
-
         # provide additional tags for blog note
         if extra_tags:
             self.params['extratags'] = "<tag>%s</tag>" % "</tag>\n<tag>".join(extra_tags)
@@ -350,10 +375,6 @@ class BlogCreator:
         })
 
         self.params['blog_link'] = f'<a href="{flickr_url}">\n{flickr_url}\n</a>'
-        self.get_albums(user)
-        self.get_galleries(user, extra_tags)
-
-        self.fetch_blog_thumbnail(blog_id, photo)
 
         # for en-media item, --en-naturalWidth ...
         self.params['media_width'] = self.params['preview_width']
@@ -370,7 +391,8 @@ class BlogCreator:
             enex_path.with_suffix('.xml').write_text(invalid_content, encoding='utf-8')
         else:
             # save generated enex file
-            enex = self.from_template(self.template_file, self.params)
+            enex = utils.from_template(self.template_file, self.params)
+            # content is embedded as CDATA, so this checks the enex envelope only (title, tags, urls)
             enex2, has_error = utils.validate_content(enex.encode('utf-8'))
 
             if has_error:
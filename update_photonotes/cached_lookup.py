@@ -4,7 +4,7 @@ or for sites that have large number of images
 """
 
 from datetime import datetime
-import json
+import orjson
 from pathlib import Path
 from colorama import Fore, Back, Style
 from flickr_api.objects import Person, Photo, FlickrList
@@ -22,34 +22,47 @@ class CachedLookupPhoto:
         if not cache_dir.is_dir():
             cache_dir.mkdir()
         self.photos = None
+        self._photo_index = None  # photo id -> pos in self.photos, see lookup_photo
         self.meta = {}
+        self.user_id = None  # user photos and meta are loaded for
+        self.config_path = cache_dir / 'lookup_cache_config.json'
+        self._config = None
+        self._config_mtime = None
+
+    def _load_config(self) -> dict:
+        """ load lookup cache config, reread only if file changed since last load """
+        if not self.config_path.is_file():
+            return {'large_sites': {}}
+        mtime = self.config_path.stat().st_mtime_ns
+        if self._config is None or mtime != self._config_mtime:
+            self._config = orjson.loads(self.config_path.read_bytes())
+            self._config_mtime = mtime
+        return self._config
 
     def flag_large_site(self, user: Person) -> None:
-        config_path = self.cache_dir / 'lookup_cache_config.json'
-        if config_path.is_file():
-            config = json.loads(config_path.read_text())
-        else:
-            config = {'large_sites': {}}
+        config = self._load_config()
         config['large_sites'][user.id] = 1
-        config_path.write_text(json.dumps(config, indent=2))
+        self.config_path.write_bytes(orjson.dumps(config, option=orjson.OPT_INDENT_2))
+        self._config = config
+        self._config_mtime = self.config_path.stat().st_mtime_ns
 
     def is_large_site(self, user: Person, ) -> bool:
-        config_path = self.cache_dir / 'lookup_cache_config.json'
-        if not config_path.is_file():
-            return False
-        else:
-            config = json.loads(config_path.read_text())
-            return config['large_sites'].get(user.id)
+        return self._load_config()['large_sites'].get(user.id)
 
     def _load_cache(self, user_id):
         """ lazy loading of cache from disk """
-        if self.photos is not None:
+        if self.photos is not None and self.user_id == user_id:
             return  # already loaded
+        # NoteCreator may be reused for more than one user, so drop what was loaded for another one
+        self.photos = None
+        self._photo_index = None
+        self.meta = {}
+        self.user_id = user_id
         data_path = self.cache_dir / (user_id + '.json')
         if not data_path.is_file():
             # cache empty / missing
             return
-        cached = json.loads(data_path.read_text())
+        cached = orjson.loads(data_path.read_bytes())
         self.meta = cached['meta']
         self.photos = cached['photos']
 
@@ -57,15 +70,16 @@ class CachedLookupPhoto:
         data_path = self.cache_dir / (user.id + '.json')
         data_path.unlink(missing_ok=True)
         self.photos = None
+        self._photo_index = None
         return
 
     def _extract_photo_info(self, photo: Photo):
-        attrs = photo.__dict__.keys()
+        # Photo.get reads loaded attributes only, so missing ones do not trigger a load (API call)
         info = {
             'id': photo.id,
             # 'title': photo.title,
-            'taken': photo.taken if 'taken' in attrs else '',
-            'uploaded': photo.dateuploaded if 'dateuploaded' in attrs else '',
+            'taken': photo.get('taken', ''),
+            'uploaded': photo.get('dateuploaded', ''),
         }
         return info
 
@@ -84,17 +98,22 @@ class CachedLookupPhoto:
             info['last_upload'] = cached['photos'][0]['uploaded']
         else:
             info['last_upload'] = ''
-        data_path.write_text(json.dumps(cached, indent=4))
+        # indented to keep cache files readable, orjson supports 2 spaces only
+        # write to temporary file first, so an interrupted write does not leave a truncated cache
+        tmp_path = data_path.with_suffix('.json.tmp')
+        tmp_path.write_bytes(orjson.dumps(cached, option=orjson.OPT_INDENT_2))
+        tmp_path.replace(data_path)
 
     def update_cache(self, user: Person, photos: FlickrList) -> None:
         """ update cache from photolist """
         self._load_cache(user.id)
-        updates = [self._extract_photo_info(photo) for photo in photos]
         if self.photos is None:
             # empty cache, simply dump list
+            updates = [self._extract_photo_info(photo) for photo in photos]
             self._store_cache(user.id, updates)
             logger.info(Back.YELLOW + f"setup cache for {user.id}, added {len(photos)} images" + Style.RESET_ALL)
-            self.photos = None  # force reload on next access
+            self.photos = updates  # keep what got stored, no need to reload on next access
+            self._photo_index = None
             return 0
 
         # if cache is not empty, then merge cache with new list
@@ -102,19 +121,23 @@ class CachedLookupPhoto:
         new_photos = []
         pos = 0
         found = None
-        newest_before = self.photos[0]
-        for photo_info in updates:
-            if photo_info['id'] == newest_before['id']:
-                # found in cache
-                found = photo_info
+        # match against all cached ids, not only the newest one - which may have been deleted on Flickr since
+        cached_ids = {photo_info['id'] for photo_info in self.photos}
+        for photo in photos:
+            if photo.id in cached_ids:
+                # found in cache, this and all older photos are known already
+                found = photo
                 break
 
             # new photo got added since last time, insert in cache at given pos
-            new_photos.append(photo_info)
+            # extract info for new photos only, usually just the first few of the list
+            new_photos.append(self._extract_photo_info(photo))
             pos += 1
 
         if len(new_photos) == 0:
+            # cache is up to date, skip rewriting it
             logger.info(Style.DIM + f"{len(self.photos)} image items in user cache"  + Style.RESET_ALL)
+            return pos
         else:
             prev_photos = self.photos
             if found is None:
@@ -131,12 +154,13 @@ class CachedLookupPhoto:
 
             self.photos = new_photos
             self.photos.extend(prev_photos)
+            self._photo_index = None  # positions changed, rebuild on next lookup
             if pos > 0:
                 logger.info(Back.YELLOW + f"added {pos} image items, have now (have {len(self.photos)}) items in cache"
                             + Style.RESET_ALL)
 
+        # self.photos is what got stored, so keep it loaded for following lookups
         self._store_cache(user.id, self.photos)
-        self.photos = None  # force cache reload on next access
         return pos
 
     def lookup_photo(self, user: Person, photo_id: str) -> tuple:
@@ -145,8 +169,13 @@ class CachedLookupPhoto:
         ##
         if not self.photos or len(self.photos) == 0:
             return 0, None
-        found = [(pos, pi) for (pos, pi) in enumerate(self.photos) if pi['id'] == photo_id]
-        if not found:
+        if self._photo_index is None:
+            # index once per loaded cache, so repeated lookups do not scan the photo list
+            self._photo_index = {}
+            for pos, photo_info in enumerate(self.photos):
+                self._photo_index.setdefault(photo_info['id'], pos)
+        pos = self._photo_index.get(photo_id)
+        if pos is None:
             return (len(self.photos), None)
         else:
-            return found[0]
+            return pos, self.photos[pos]
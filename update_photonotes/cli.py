@@ -33,7 +33,6 @@ from update_photonotes.log_config import setup_logging
 from . import utils
 from . import cli_app
 
-setup_logging()
 logger = logging.getLogger('updater')
 
 @click.group(cls=NaturalOrderGroup)
@@ -193,6 +192,7 @@ def extract_content(enex_path):
     
     Expects a Flickr URL to create note from (blog or photo)
     If parameter is omitted, then the URL will be taken from the current Clipboard content.
+    Clipboard may contain more than one URL (one per line) to create a note for each.
     """
 )
 @click.argument(
@@ -220,6 +220,7 @@ def create_note(
     # note: using authenticated session influences visibility (e.g. of Albums), so use by default
     options.use_auth_session = True  # use authentication session if available
     options.xml = False  # do not dump .xml by default - only in case of error
+    options.debug = os.getenv("DEBUG") == '1'
     try:
         cli_app.create_note(
             options,
@@ -233,6 +234,8 @@ def create_note(
 
 
 def main() -> None:
+    # configure logging when run as CLI app, not as side effect of importing this module
+    setup_logging()
     try:
         utils.load_dotenv()
         updater()
@@ -8,14 +8,9 @@ from pathlib import Path
 from types import SimpleNamespace
 from typing import Optional
 
-import pyclip
-
 from .database import PhotoNotesDB
-from .authenticate import authenticate_session
-from .updater import NotesUpdater
-from .note_creator import NoteCreator
-from .blog_creator import BlogCreator
-from .note_utils import extract_enex_content
+# note: pyclip, flickr_api, requests_cache and lxml based modules are imported on demand in the
+# actions needing them, so that other actions (e.g. reset-db) start up quickly
 
 import logging
 logger = logging.getLogger(__name__)
@@ -37,8 +32,10 @@ def get_notes_db(db_path: Path) -> PhotoNotesDB:
 
 
 def text_from_clipboard():
-    cb_data = pyclip.paste()
-    text = cb_data.decode('latin-1')  # TODO default encoding?
+    import pyclip
+    # text=True: get str as provided by the platform clipboard, instead of bytes to decode here
+    # (on Windows, bytes returned are UTF-8 encoded, so decoding them as latin-1 broke non-ASCII urls)
+    text = pyclip.paste(text=True)
     return text
 
 
@@ -47,6 +44,7 @@ def authenticate(
         permissions: str,
 ) -> None:
     """ authenticate user for requested permissions """
+    from .authenticate import authenticate_session
     authenticate_session(options, permissions)
 
 
@@ -67,6 +65,7 @@ def update_db(
         notebook: str,
 ) -> None:
     """ update photonotes db from evernote-backup created db """
+    from .updater import NotesUpdater
     db_path = get_db_path()
     options.db_path = db_path
     notes_db = get_notes_db(db_path)
@@ -80,6 +79,7 @@ def update_db(
 
 
 def extract_content(enex_path):
+    from .note_utils import extract_enex_content
     enex_path = Path(enex_path)
     result = extract_enex_content(enex_path)
     logger.info(f"extracted content see {result}")
@@ -87,6 +87,8 @@ def extract_content(enex_path):
 
 
 def create_note(options: SimpleNamespace, flickr_url: Optional[str] = None, ) -> None:
+    from .note_creator import NoteCreator
+    from .blog_creator import BlogCreator
     # to pass configuration dependent options to create handler
     db_path = get_db_path()
     options.db_path = db_path
@@ -107,14 +109,31 @@ def create_note(options: SimpleNamespace, flickr_url: Optional[str] = None, ) ->
     else:
         logger.debug(f"use Flickr URL specified on commandline: {url!r}")
 
-    if "/people/" in url:
-        logger.info(f"creating photonote for user's blog from URL {url!r}")
-        ok = BlogCreator(notes_db, options).create_note(url)
-    elif "/photos/" in url:
-        logger.info(f"creating photonote for photo from URL {url!r}")
-        ok = NoteCreator(notes_db, options).create_note(url)
-    else:
+    # clipboard may contain more than one URL, one per line
+    urls = [line.strip() for line in url.splitlines() if line.strip()]
+    if not urls:
         raise ValueError(f"unrecognized or unsupported Flickr URL: {url!r}")
+    if len(urls) > 1:
+        logger.info(f"creating photonotes for {len(urls)} URLs")
+
+    # reuse creators for all URLs, so session, authentication and api cache are set up only once
+    blog_creator = None
+    note_creator = None
+    ok = True
+    for url in urls:
+        if "/people/" in url:
+            logger.info(f"creating photonote for user's blog from URL {url!r}")
+            if blog_creator is None:
+                blog_creator = BlogCreator(notes_db, options)
+            created = blog_creator.create_note(url)
+        elif "/photos/" in url:
+            logger.info(f"creating photonote for photo from URL {url!r}")
+            if note_creator is None:
+                note_creator = NoteCreator(notes_db, options)
+            created = note_creator.create_note(url)
+        else:
+            raise ValueError(f"unrecognized or unsupported Flickr URL: {url!r}")
+        ok = ok and created is True
 
     if ok is True:
         logger.info("create_note completed.")
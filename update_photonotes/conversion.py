@@ -13,9 +13,10 @@ def get_note_content(content_body: Optional[str]) -> Optional[str]:
     body = content_body.strip()
 
     # <?xml version="1.0" encoding="UTF-8"?>
-    if body.startswith("<?xml") and body.find(">") != -1:
+    if body.startswith("<?xml"):
         content_start = body.find(">") + 1
-        body = body[content_start:].strip()
+        if content_start:
+            body = body[content_start:].strip()
 
     return body
 
@@ -4,7 +4,7 @@ store and maintain photo nots related info
 """
 import lzma
 import pickle
-from typing import Optional
+from typing import Callable, Optional
 import sqlite3
 
 from evernote_backup.note_storage import SqliteStorage
@@ -56,15 +56,83 @@ CREATE INDEX IF NOT EXISTS idx_key
   
 CREATE INDEX IF NOT EXISTS idx_image_blog
   ON flickr_image(blog_id);
+
+CREATE INDEX IF NOT EXISTS idx_image_lookup
+  ON flickr_image(image_key, is_primary, photo_uploaded DESC);
 """
 
+# indexes added to DB_SCHEMA_PN later on, created by extend_db for existing databases
+DB_INDEXES_PN = {
+    'idx_image_lookup': (
+        "CREATE INDEX IF NOT EXISTS idx_image_lookup"
+        " ON flickr_image(image_key, is_primary, photo_uploaded DESC)"
+    ),
+}
+
+# columns written by FlickrImageStorage.update_images
+# info from Flickr we currently do not yet have - FUTURE addition:
+# secret_id, size_suffix, photo_taken, photo_uploaded, is_gone
+IMAGE_UPDATE_COLUMNS = (
+    'entry_updated',
+    'is_primary',
+    'image_key',
+    'photo_id',
+    'blog_id',
+    'guid_note',
+    'note_tags',
+    'date_verified',
+)
+IMAGE_UPDATE_SQL = "REPLACE INTO flickr_image(%s) VALUES (%s)" % (
+    ', '.join(IMAGE_UPDATE_COLUMNS), ', '.join('?' * len(IMAGE_UPDATE_COLUMNS)),
+)
+
+
+# columns read by lookups, in order unpacked by FlickrBlogStorage._create_blog
+# and FlickrImageStorage._load_photo_note
+BLOG_COLUMNS = "blog_id, guid_note, is_gone, last_upload, favorite, image_count, entry_updated, date_verified"
+IMAGE_COLUMNS = (
+    "image_key, guid_note, is_primary, note_tags, blog_id, entry_updated, date_verified,"
+    " photo_id, secret_id, size_suffix, photo_taken, photo_uploaded, is_gone"
+)
+
+# lookups, read-only so executed without transaction (sqlite3 module caches the prepared statements)
+BLOG_BY_NOTE_SQL = f"SELECT {BLOG_COLUMNS} FROM flickr_blog WHERE guid_note=?"
+ALL_BLOGS_SQL = f"SELECT {BLOG_COLUMNS} FROM flickr_blog"
+IMAGE_BY_NOTE_SQL = f"SELECT {IMAGE_COLUMNS} FROM flickr_image WHERE guid_note=?"
+IMAGE_PRIMARY_SQL = f"SELECT {IMAGE_COLUMNS} FROM flickr_image WHERE image_key=? AND guid_note=? AND is_primary=1"
+IMAGE_BY_KEY_PRIMARY_SQL = (
+    f"SELECT {IMAGE_COLUMNS} FROM flickr_image WHERE image_key=? AND is_primary=1"
+    " ORDER BY photo_uploaded DESC"
+)
+IMAGE_BY_KEY_SQL = (
+    f"SELECT {IMAGE_COLUMNS} FROM flickr_image WHERE image_key=?"
+    " ORDER BY is_primary DESC, photo_uploaded DESC"
+)
+IMAGE_KEYS_SQL = "SELECT DISTINCT image_key FROM flickr_image"
+
+
+# connection settings applied when opening the db, all per connection only (not persisted in db file)
+# note: journal_mode=WAL is not set, as it changes the db file used by evernote-backup as well
+DB_PRAGMAS = (
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",  # in KiB, i.e. 64 MB
+    "PRAGMA mmap_size=268435456",  # 256 MB
+)
+
+
 class PhotoNotesDB:
 
     def __init__(self, dbpath, reset=False):
         self.wrapped_store = SqliteStorage(dbpath)
+        for pragma in DB_PRAGMAS:
+            self.wrapped_store.db.execute(pragma)
+        self._image_keys = None  # image keys in flickr_image, loaded on first lookup_primary
         if reset:
             self.reduce_db()
         self.extend_db()
+        # storage wrappers share the connection of wrapped_store, so create them once
+        self._flickrblogs = FlickrBlogStorage(self.wrapped_store.db)
+        self._flickrimages = FlickrImageStorage(self.wrapped_store.db, get_image_keys=lambda: self.image_keys)
 
     @property
     def store(self) -> "SqliteStorage":
@@ -72,11 +140,18 @@ class PhotoNotesDB:
 
     @property
     def flickrblogs(self) -> "FlickrBlogStorage":
-        return FlickrBlogStorage(self.wrapped_store.db)
+        return self._flickrblogs
 
     @property
     def flickrimages(self) -> "FlickrPhotoStorage":
-        return FlickrImageStorage(self.wrapped_store.db)
+        return self._flickrimages
+
+    @property
+    def image_keys(self) -> set:
+        """ image keys in flickr_image, loaded once and kept up to date by FlickrImageStorage """
+        if self._image_keys is None:
+            self._image_keys = {row[0] for row in self.wrapped_store.db.execute(IMAGE_KEYS_SQL)}
+        return self._image_keys
 
     def reduce_db(self):
         """ remove tables added """
@@ -85,62 +160,78 @@ class PhotoNotesDB:
             con.execute("DROP TABLE IF EXISTS flickr_image;")
             con.execute("DROP TABLE IF EXISTS flickr_blog;")
             con.execute("COMMIT TRANSACTION;")
+        self._image_keys = None
 
     def extend_db(self):
         """ add tables to exixting database - if not already there """
         with self.wrapped_store.db as con:
-            try:
-                con.execute("SELECT * FROM flickr_image WHERE image_key=NULL")
-            except sqlite3.OperationalError as err:
-                if "no such table: " not in str(err):
-                    raise RuntimeError(f"failed to access flickr_image - {err!r}")
-                logger.info("table flickr_blog does not yet exist, need to create first")
-            else:
+            cur = con.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='flickr_image' LIMIT 1"
+            )
+            if cur.fetchone() is not None:
+                self._add_missing_indexes(con)
                 return
+            logger.info("table flickr_blog does not yet exist, need to create first")
             con.executescript(DB_SCHEMA_PN)
             con.commit()
         return
 
+    def _add_missing_indexes(self, con):
+        """ create indexes missing in databases extended by an earlier version """
+        existing = {row[0] for row in con.execute(
+            "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='flickr_image'"
+        )}
+        missing = [name for name in DB_INDEXES_PN if name not in existing]
+        if not missing:
+            return
+        for name in missing:
+            logger.info(f"adding index {name} to table flickr_image")
+            con.execute(DB_INDEXES_PN[name])
+        # update statistics once, so the planner picks up the new index(es); limited to flickr_image
+        # to not touch the tables of evernote-backup
+        con.execute("ANALYZE flickr_image")
+        return
+
 
 class FlickrBlogStorage(SqliteStorage):
     """ wraps CRUD operations on flickr_blog """
 
+    def __init__(self, database):
+        super().__init__(database)
+        # rows by blog_id, all loaded with a single query on first lookup_blog_by_id - for each image
+        # link in a photo note the blog is looked up, and flickr_blog is not updated while running
+        self._blog_rows = None
+
     def _create_blog(self, row):
         """ factory method to create FlickrBlog from SQLite row """
-        blog = FlickrPhotoBlog(row["blog_id"], row["guid_note"])
-        blog.is_gone = row["is_gone"]
-        blog.last_upload = FlickrDate(row["last_upload"])
-        blog.favorite = row["favorite"]
-        blog.image_count = row["image_count"]
-        blog.entry_updated = FlickrDate(row["entry_updated"])
-        blog.verified = FlickrDate(row["verified"])
+        (blog_id, guid_note, is_gone, last_upload, favorite, image_count,
+         entry_updated, date_verified) = row  # see BLOG_COLUMNS
+        blog = FlickrPhotoBlog(blog_id, guid_note)
+        blog.is_gone = is_gone
+        blog.last_upload = FlickrDate(last_upload)
+        blog.favorite = favorite
+        blog.image_count = image_count
+        blog.entry_updated = FlickrDate(entry_updated)
+        blog.verified = FlickrDate(date_verified)
         return blog
 
     def lookup_blog_by_note(self, guid_note):
-        with self.db as con:
-            cur = con.execute(
-                "SELECT * FROM flickr_blog WHERE guid_note=?",
-                (guid_note,),
-            )
-            row = cur.fetchone()
-            if row is None:
-                raise ValueError(f"Flickr blog not found for photo note guid={guid_note}")
+        row = self.db.execute(BLOG_BY_NOTE_SQL, (guid_note,)).fetchone()
+        if row is None:
+            raise ValueError(f"Flickr blog not found for photo note guid={guid_note}")
 
-            blog = self._create_blog(row)
-            return blog
+        blog = self._create_blog(row)
+        return blog
 
     def lookup_blog_by_id(self, blog_id):
-        with self.db as con:
-            cur = con.execute(
-                "SELECT * FROM flickr_blog WHERE blog_id=?",
-                (blog_id,)
-            )
-            row = cur.fetchone()
-            if row is None:
-                raise ValueError(f"Flickr blog not found for blog id={blog_id}")
+        if self._blog_rows is None:
+            self._blog_rows = {row[0]: row for row in self.db.execute(ALL_BLOGS_SQL)}  # row[0] is blog_id
+        row = self._blog_rows.get(blog_id)
+        if row is None:
+            raise ValueError(f"Flickr blog not found for blog id={blog_id}")
 
-            blog = self._create_blog(row)
-            return blog
+        blog = self._create_blog(row)
+        return blog
 
 
 class FlickrImageStorage(SqliteStorage):
@@ -149,118 +240,111 @@ class FlickrImageStorage(SqliteStorage):
     # we actually have a description of a Flickr image in an Evernote note identified
     # by this object - naming should be updated / improved (FUTURE)
 
+    def __init__(self, database, get_image_keys: Optional[Callable[[], set]] = None):
+        super().__init__(database)
+        # image keys known to be in flickr_image, to skip querying for new images, see lookup_primary
+        self.get_image_keys = get_image_keys
+
     def _load_photo_note(self, row):
         """ factory method to create FlickrPhotoNote from SQLite row """
-        image = FlickrPhotoNote(row["image_key"], row["guid_note"])
-
-        image.is_primary = row["is_primary"]
-        image.note_tags = row["note_tags"]
-        image.blog_id = row["blog_id"]
-        image.entry_updated = FlickrDate(row["entry_updated"])
-        image.date_verified = FlickrDate(row["date_verified"])
-        image.photo_id = row["photo_id"]
-        image.secret_id = row["secret_id"]
-        image.size_suffix = row["size_suffix"]
-        image.photo_taken = FlickrDate(row["photo_taken"])
-        image.photo_uploaded = FlickrDate(row["photo_uploaded"])
-        image.is_gone = row["is_gone"]
+        (image_key, guid_note, is_primary, note_tags, blog_id, entry_updated, date_verified,
+         photo_id, secret_id, size_suffix, photo_taken, photo_uploaded, is_gone) = row  # see IMAGE_COLUMNS
+        image = FlickrPhotoNote(image_key, guid_note)
+
+        image.is_primary = is_primary
+        image.note_tags = note_tags
+        image.blog_id = blog_id
+        image.entry_updated = FlickrDate(entry_updated)
+        image.date_verified = FlickrDate(date_verified)
+        image.photo_id = photo_id
+        image.secret_id = secret_id
+        image.size_suffix = size_suffix
+        image.photo_taken = FlickrDate(photo_taken)
+        image.photo_uploaded = FlickrDate(photo_uploaded)
+        image.is_gone = is_gone
         return image
 
     def count_images(self, filter: str = ""):
-        with self.db as con:
-            query = "SELECT COUNT(*) FROM flickr_image WHERE "
-            if filter:
-                query += filter
-            else:
-                query += "1=1"
-            cur = con.execute(query)
-            return int(cur.fetchone()[0])
+        query = "SELECT COUNT(*) FROM flickr_image WHERE "
+        if filter:
+            query += filter
+        else:
+            query += "1=1"
+        cur = self.db.execute(query)
+        return int(cur.fetchone()[0])
 
     def lookup_by_note(self, guid_note):
-        with self.db as con:
-            cur = con.execute(
-                "SELECT * FROM flickr_image WHERE guid_note=?",
-                (guid_note,),
-            )
-            row = cur.fetchone()
-            if row is None:
-                raise ValueError(f"Flickr image not found for photo note guid={guid_note}")
+        row = self.db.execute(IMAGE_BY_NOTE_SQL, (guid_note,)).fetchone()
+        if row is None:
+            raise ValueError(f"Flickr image not found for photo note guid={guid_note}")
 
-            image = self._load_photo_note(row)
-            return image
+        image = self._load_photo_note(row)
+        return image
 
     def lookup_image(self, image_key, is_primary=True):
         """ lookup note for Flickr """
-        with self.db as con:
-            query = "SELECT * FROM flickr_image WHERE image_key=?"
-            if is_primary is not None:
-                query += " AND is_primary=1"
-                query += " ORDER BY photo_uploaded DESC"
-            else:
-                query += " ORDER BY is_primary DESC, photo_uploaded DESC"
-            cur = con.execute(query, (image_key, ),)
-            rows = cur.fetchall()
-            if len(rows) == 0:
-                raise PhotoNoteNotFound(f"Photo-note not found for image key={image_key}")
-            else:
-                photo_notes = [self._load_photo_note(row) for row in rows]
-                return photo_notes
+        if is_primary is not None:
+            query = IMAGE_BY_KEY_PRIMARY_SQL
+        else:
+            query = IMAGE_BY_KEY_SQL
+        cur = self.db.execute(query, (image_key, ),)
+        rows = cur.fetchall()
+        if len(rows) == 0:
+            raise PhotoNoteNotFound(f"Photo-note not found for image key={image_key}")
+        else:
+            photo_notes = [self._load_photo_note(row) for row in rows]
+            return photo_notes
 
 
     def lookup_primary(self, image_key: str, guid_note: str) -> FlickrPhotoNote:
         """ lookup primary Flickr image for given note """
-        with self.db as con:
-            cur = con.execute(
-                "SELECT * FROM flickr_image WHERE image_key=? AND guid_note=? AND is_primary=1",
-                (image_key, guid_note),
-            )
-            # note that image_key is primary key, so expect one row or nothing
-            row = cur.fetchone()
-            if not row:
-                raise PhotoNoteNotFound(f"Photo-note not found for image key={image_key}")
-            else:
-                photo_note = self._load_photo_note(row)
-                return photo_note
+        if self.get_image_keys is not None and image_key not in self.get_image_keys():
+            raise PhotoNoteNotFound(f"Photo-note not found for image key={image_key}")
+        row = self.db.execute(IMAGE_PRIMARY_SQL, (image_key, guid_note)).fetchone()
+        # note that image_key is primary key, so expect one row or nothing
+        if not row:
+            raise PhotoNoteNotFound(f"Photo-note not found for image key={image_key}")
+        else:
+            photo_note = self._load_photo_note(row)
+            return photo_note
 
     def update_image(self, photonote, flickr_link, is_primary, log_changes=True):
         """ create or update image in database """
-        updated_before = photonote.entry_updated
-        values = {
-            'entry_updated': FlickrDate.today().serialize(),
-            'is_primary': is_primary,
-            'image_key': flickr_link['image_key'],
-            'photo_id': flickr_link['photo_id'],
-            'blog_id': flickr_link['blog_id'],
-            'guid_note': photonote.guid_note,
-            'note_tags': photonote.note_tags,
-            'date_verified': photonote.date_verified.serialize(),
-            # info from Flickr we currently do not yet have - FUTURE addition
-            # 'secret_id',
-            # 'size_suffix',
-            # 'photo_taken',
-            # 'photo_uploaded',
-            # 'is_gone'
-        }
-        dbkeys = list(values.keys())
-        dbvalues = []
-        for key in dbkeys:
-            dbvalues.append(values[key])
-
-        markers = ('?, '*len(dbkeys))[:-2]
-        with self.db as con:
-            con.execute(
-                "replace into flickr_image(%s) values (%s)" % (', '.join(dbkeys), markers),
-                tuple(dbvalues),
+        self.update_images([(photonote, flickr_link, is_primary)], log_changes=log_changes)
+
+    def update_images(self, items, log_changes=True):
+        """ create or update images in database, items are tuples (photonote, flickr_link, is_primary) """
+        entry_updated = FlickrDate.today().serialize()
+        # values in order of IMAGE_UPDATE_COLUMNS
+        rows = [
+            (
+                entry_updated,
+                is_primary,
+                flickr_link['image_key'],
+                flickr_link['photo_id'],
+                flickr_link['blog_id'],
+                photonote.guid_note,
+                photonote.note_tags,
+                photonote.date_verified.serialize(),
             )
+            for photonote, flickr_link, is_primary in items
+        ]
+        # single transaction for all images passed
+        with self.db as con:
+            con.executemany(IMAGE_UPDATE_SQL, rows)
+        if self.get_image_keys is not None:
+            self.get_image_keys().update(flickr_link['image_key'] for _, flickr_link, _ in items)
 
         if log_changes:
-            info = f"photo-note entry for image key={flickr_link['image_key']} "
-            if is_primary:
-                info += "[primary] "
-            if updated_before:
-                logger.info(f"updated {info} updated_before={updated_before}")
-            else:
-                logger.info(f"created {info}")
+            for photonote, flickr_link, is_primary in items:
+                updated_before = photonote.entry_updated
+                info = f"photo-note entry for image key={flickr_link['image_key']} "
+                if is_primary:
+                    info += "[primary] "
+                if updated_before:
+                    logger.info(f"updated {info} updated_before={updated_before}")
+                else:
+                    logger.info(f"created {info}")
 
 
 def lookup_note(store: SqliteStorage, note_guid: str) -> Optional[Note]:
@@ -285,3 +369,15 @@ def lookup_note(store: SqliteStorage, note_guid: str) -> Optional[Note]:
 
         note = pickle.loads(lzma.decompress(row["raw_note"]))
         return note
+
+
+def lookup_note_meta(store: SqliteStorage, note_guid: str) -> sqlite3.Row:
+    """ lookup guid, title, notebook_guid and is_active of Evernote note in evernote-backup db """
+    # reads plain columns of table notes, so avoids decompressing and unpickling raw_note
+    row = store.db.execute(
+        "SELECT guid, title, notebook_guid, is_active FROM notes WHERE guid=?",
+        (note_guid, )
+    ).fetchone()
+    if row is None:
+        raise NoteNotFound(f"Evernote note not found for guid={note_guid!r}")
+    return row
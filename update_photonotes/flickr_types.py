@@ -8,33 +8,42 @@ from typing import Optional
 
 class FlickrDate(object):
     """ wraps a date value - with serialization from/to SQLite """
+    # slots: instantiated for every date column of each row loaded, so keep instances small
+    __slots__ = ('_raw', '_value')
 
     def __init__(self, value: Optional[str]):
-        if value is not None:
-            value = datetime.date.fromisoformat(value)
-        self._value = value
+        # keep ISO string as read from SQLite, parse it only when date value gets accessed
+        # (rows are loaded for every photo note, but their dates are seldom looked at)
+        self._raw = value
+        self._value = None
 
     def __str__(self):
-        if self._value is None:
+        if self._raw is None:
             return '(not set)'
         else:
-            return self._value.isoformat()
+            return self.serialize()
 
     def __repr__(self):
         value = str(self)
         return f"Flickrdate({value})"
 
     def __bool__(self):
-        return self._value is not None
+        return self._raw is not None
 
     def serialize(self) -> Optional[str]:
         """ serialize for SQLite """
-        if self._value is not None:
-            return self._value.strftime("%Y-%m-%d")
-        return None
+        if self._raw is None:
+            return None
+        if len(self._raw) == 10 and self._raw[4] == '-' and self._raw[7] == '-':
+            # already in YYYY-MM-DD form, as written by serialize
+            return self._raw
+        # isoformat gives YYYY-MM-DD for dates, without strftime format interpretation
+        return self.value.isoformat()
 
     @property
     def value(self) -> Optional[datetime.date]:
+        if self._value is None and self._raw is not None:
+            self._value = datetime.date.fromisoformat(self._raw)
         return self._value
 
     @staticmethod
@@ -45,6 +54,10 @@ class FlickrDate(object):
 
 class FlickrPhotoBlog(object):
     """ represents a Flickr photo blog entry """
+    __slots__ = (
+        'blog_id', 'guid_note', 'is_gone', 'last_upload', 'favorite', 'image_count',
+        'entry_updated', 'verified',
+    )
 
     def __init__(self, blog_id: str, guid_note: str):
         self.blog_id = blog_id
@@ -59,6 +72,12 @@ class FlickrPhotoBlog(object):
 
 class FlickrPhotoNote(object):
     """ represents a Photo-note (Note on flickr image) """
+    # slots: instantiated per flickr_image row, and per image link found in notes
+    __slots__ = (
+        'image_key', 'guid_note', 'is_primary', 'note_tags', 'blog_id', 'need_cleanup',
+        'date_verified', 'photo_id', 'secret_id', 'size_suffix', 'photo_taken', 'photo_uploaded',
+        'entry_updated', 'is_gone',
+    )
 
     def __init__(self, image_key: str, guid_note: str):
         self.image_key = image_key
@@ -89,9 +108,11 @@ class FlickrPhotoNote(object):
             values = [value, ]
         else:
             values = value
-        for value in values:
-            if value not in cleanups:
-                cleanups.add(value)
+        added = [value for value in values if value not in cleanups]
+        if not added:
+            # all known already, keep need_cleanup as is instead of rejoining it
+            return
+        cleanups.update(added)
         self.need_cleanup = '|'.join(cleanups)
 
     def clear_cleanup(self):
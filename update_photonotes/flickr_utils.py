@@ -3,9 +3,24 @@ utilities to handle Flickr objects
 """
 
 import os
-from datetime import datetime
+import re
+import contextlib
+import functools
+import time
+import pickle
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+from urllib.parse import unquote
+from datetime import datetime, timedelta
 from lxml import etree
+import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import flickr_api
+from flickr_api import method_call
 from flickr_api.objects import Photo, Person
 
 from . import utils
@@ -13,18 +28,59 @@ from . import utils
 import logging
 logger = logging.getLogger('flickr_utils')
 
+# connection pool for api.flickr.com and *.staticflickr.com, sized for concurrent API calls
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+# prefix of Flickr REST API url, mounted without retries, see mount_pooled_adapter
+API_URL_PREFIX = 'https://api.flickr.com/'
+
+# expiration of cached responses from Flickr (if REQUESTS_CACHE=1), see create_session
+API_CACHE_EXPIRE = timedelta(days=6)
+IMAGE_CACHE_EXPIRE = timedelta(days=30)
+
+# flickr api method name in cache key (urlencoded api call args)
+API_METHOD_RE = re.compile(r'(?:^|&)method=([^&]*)')
+
+# API methods listing photos, galleries or albums - results change with new uploads, so do not
+# persist them across runs, see PersistentAPIcallsCache
+VOLATILE_API_METHODS = frozenset((
+    'flickr.people.getInfo',
+    'flickr.people.getPhotos',
+    'flickr.people.getPublicPhotos',
+    'flickr.photos.search',
+    'flickr.galleries.getList',
+    'flickr.photosets.getList',
+))
+
+# license names by Flickr license id, see get_license_info
+LICENSE_INFO = {
+    '0': 'All Rights reserved',
+    '1': 'CC BY-NC-SA 2.0',
+    '2': 'CC BY-NC 2.0',
+    '3': 'CC BY-NC-ND 2.0',
+    '4': 'CC BY 2.0',
+    '5': 'CC BY-SA 2.0',
+    '6': 'CC BY-ND 2.0',
+    # '7': 'License Type 7',
+    # '8': 'License Type 8',
+    '9': 'CC0 1.0 Public Domain',
+    '10': 'Public Domain Mark 1.0',
+    # '11': 'License Type 11',
+}
+
+# anchors in photo description, see cleanup_description
+ANCHORS_XPATH = etree.XPath("//a")
+
+
+@functools.lru_cache(maxsize=32)
+def _flickr_url_prefixes(suffix: str, allow_http: bool) -> tuple:
+    schemes = ('https', 'http') if allow_http else ('https',)
+    return tuple(f'{scheme}://{host}/{suffix}' for scheme in schemes for host in ('www.flickr.com', 'flickr.com'))
+
 
 def is_flickr_url(url, suffix='', allow_http=False):
-    if url.startswith(f'https://www.flickr.com/{suffix}'):
-        return True
-    if url.startswith(f'https://flickr.com/{suffix}'):
-        return True
-    if allow_http:
-        if url.startswith(f'http://www.flickr.com/{suffix}'):
-            return True
-        if url.startswith(f'http://flickr.com/{suffix}'):
-            return True
-    return False
+    return url.startswith(_flickr_url_prefixes(suffix, allow_http))
 
 
 def get_auth_file():
@@ -53,6 +109,119 @@ def authenticate(use_auth_session=True):
     return
 
 
+def mount_pooled_adapter(session: requests.Session) -> None:
+    """ keep connections alive for given session, retry image downloads on transient errors """
+    retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+    )
+    session.mount('https://', HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        max_retries=retries,
+    ))
+    # no retries for API calls, flickr_api retries them on its own (see method_call.MAX_RETRIES)
+    session.mount(API_URL_PREFIX, HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=POOL_MAXSIZE,
+        max_retries=0,
+    ))
+
+
+def is_volatile_api_call(args) -> bool:
+    """ check urlencoded api call args for a method listed in VOLATILE_API_METHODS """
+    method = API_METHOD_RE.search(args)
+    return method is not None and unquote(method.group(1)) in VOLATILE_API_METHODS
+
+
+def is_api_success(response) -> bool:
+    """ check for successful response, Flickr reports API errors as HTTP 200 with stat=fail """
+    if getattr(response, 'status_code', None) != 200:
+        return False
+    try:
+        return response.json().get('stat') == 'ok'
+    except ValueError:
+        # raw (xml) response
+        return b'stat="ok"' in response.content
+
+
+def is_cacheable_response(response) -> bool:
+    """ filter for CachedSession: cache images and successful, non-volatile API calls only """
+    if not response.url.startswith(API_URL_PREFIX):
+        return True
+    body = response.request.body or ''
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', errors='replace')
+    return is_api_success(response) and not is_volatile_api_call(body)
+
+
+def create_session(use_cache: bool = False) -> requests.Session:
+    """ create session for Flickr API calls and image downloads """
+    if not use_cache:
+        session = requests.session()
+    else:
+        # cache as much as we can to reduce number of API calls; note that flickr_api
+        # uses POST for the REST calls, so need to enable caching for POST explicitly
+        # oauth parameters change per call, so exclude them from cache key
+        session = requests_cache.CachedSession(
+            'note_creator',
+            backend='sqlite',
+            expire_after=API_CACHE_EXPIRE,
+            urls_expire_after={
+                '*flickr.com/services/rest*': API_CACHE_EXPIRE,
+                '*staticflickr.com*': IMAGE_CACHE_EXPIRE,
+            },
+            allowable_methods=('GET', 'POST'),
+            allowable_codes=(200,),
+            # same rules as PersistentAPIcallsCache, applied when writing and reading the cache
+            filter_fn=is_cacheable_response,
+            ignored_parameters=requests_cache.DEFAULT_IGNORED_PARAMS + (
+                'oauth_nonce', 'oauth_timestamp', 'oauth_signature',
+            ),
+            match_headers=False,
+            stale_if_error=True,
+        )
+    mount_pooled_adapter(session)
+    return session
+
+
+class _SessionTransport:
+    """ stands in for module requests in flickr_api.method_call, posting API calls through a session """
+
+    def __init__(self, session: requests.Session):
+        self.post = session.post
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+# guards swapping of module globals in flickr_api.method_call, see route_api_calls
+_ROUTE_LOCK = threading.RLock()
+
+
+@contextlib.contextmanager
+def route_api_calls(session: requests.Session, api_cache: Optional["CountingAPIcallsCache"] = None):
+    """ let flickr_api send its REST calls through given session and cache, while in with block
+
+    method_call.requests and method_call.CACHE are process-wide, so the lock is held for the
+    whole with block: creators running in other threads wait, nested use in the same thread
+    restores in order; threads started within the block (e.g. executor workers) use the
+    session and cache routed to
+    """
+    # flickr_api uses requests.post, what opens a new connection (and TLS handshake) per API call
+    with _ROUTE_LOCK:
+        prev_transport, prev_cache = method_call.requests, method_call.CACHE
+        method_call.requests = _SessionTransport(session)
+        if api_cache is not None:
+            flickr_api.enable_cache(api_cache)
+        try:
+            yield session
+        finally:
+            method_call.requests, method_call.CACHE = prev_transport, prev_cache
+
+
 def get_credentials():
     """ get credentials, load from .env file """
     # see .utils.load_dotenv for fetching environment variables from .env
@@ -82,14 +251,19 @@ def get_firstdatetaken(user: Person) -> str:
     return value
 
 
+def format_timestamp(value) -> str:
+    """ format unix timestamp from Flickr as ISO date (local time) """
+    # time.strftime avoids creating a datetime object, used in loops over albums and galleries
+    return time.strftime("%Y-%m-%d", time.localtime(int(value)))
+
+
 def get_lastupdate(photo: Photo) -> str:
     update = datetime.fromtimestamp(photo.lastupdate)
     return update.isoformat()[:10]
 
 
 def get_uploaded(photo: Photo) -> str:
-    uploaded = datetime.fromtimestamp(int(photo.dateuploaded))
-    return uploaded.isoformat()[:10]
+    return format_timestamp(photo.dateuploaded)
 
 
 def get_taken(photo: Photo) -> str:
@@ -110,23 +284,7 @@ def get_taken(photo: Photo) -> str:
 
 
 def get_license_info(photo: Photo) -> str:
-    license_info = {
-        '0': 'All Rights reserved',
-        '1': 'CC BY-NC-SA 2.0',
-        '2': 'CC BY-NC 2.0',
-        '3': 'CC BY-NC-ND 2.0',
-        '4': 'CC BY 2.0',
-        '5': 'CC BY-SA 2.0',
-        '6': 'CC BY-ND 2.0',
-        # '7': 'License Type 7',
-        # '8': 'License Type 8',
-        '9': 'CC0 1.0 Public Domain',
-        '10': 'Public Domain Mark 1.0',
-        # '11': 'License Type 11',
-        #
-        #
-    }.get(photo.license)
-    return license_info
+    return LICENSE_INFO.get(photo.license)
 
 
 def cleanup_description(desc: str) -> str:
@@ -135,9 +293,9 @@ def cleanup_description(desc: str) -> str:
 
     # replace HTML style links by markup style ones
     xml = etree.fromstring('<div class="note-description">' + desc + '</div>')
-    for anchor in xml.xpath("//a"):
-        href = anchor.attrib.get("href")
-        link_text =  " ".join(anchor.xpath(".//text()"))
+    for anchor in ANCHORS_XPATH(xml):
+        href = anchor.get("href")
+        link_text =  " ".join(anchor.itertext())
         if not link_text:
             link_text = href
         if link_text == href:
@@ -151,15 +309,14 @@ def cleanup_description(desc: str) -> str:
         except Exception as err:  # XMLSyntaxError
             logger.error(f"failed to transform html anchor to markup link - {err!r}")
         else:
-            markup_link.attrib["style"] = "--en-highlight:blue"
+            markup_link.set("style", "--en-highlight:blue")
             anchor.getparent().replace(anchor, markup_link)
 
     # get pretty-printed description
     result = etree.tostring(xml,
-                            encoding='utf-8',
-                            xml_declaration=False,
+                            encoding='unicode',
                             pretty_print=True
-                            ).decode('utf-8').strip()
+                            ).strip()
     return result
 
 
@@ -196,20 +353,100 @@ class CountingAPIcallsCache(flickr_api.cache.SimpleCache):
         info += '\n.'
         return info
 
-    # @locking  # reuse locking from base class?
-    # assume usage is synchronously / single-threaded, so live without
     def has_key(self, key):
-        found = super().has_key(key)
+        # API calls may be issued concurrently (see BlogCreator), so reuse lock from base class
+        # to keep counters consistent
+        with self.lock:
+            found = super().has_key(key)
 
-        # track cache miss / hit
-        cache_map = self.cache_miss if not found else self.cache_hit
-        cache_map['_all'] = cache_map.get('_all', 0) +1
+            # track cache miss / hit
+            cache_map = self.cache_miss if not found else self.cache_hit
+            cache_map['_all'] = cache_map.get('_all', 0) +1
 
-        # determine flickr api method, track per method
-        items = key.split('&')
-        method = [ item for item in items if item.startswith('method=')]
-        method_name = method[0].split('=')[1] if method else 'unknown'
-        cache_map[method_name] = cache_map.get(method_name, 0) +1
+            # determine flickr api method, track per method
+            method = API_METHOD_RE.search(key)
+            method_name = method.group(1) if method else 'unknown'
+            cache_map[method_name] = cache_map.get(method_name, 0) +1
 
         return found
 
+
+class PersistentAPIcallsCache(CountingAPIcallsCache):
+    """ API calls cache stored in SQLite, so results get reused across runs
+
+    only successful responses get stored; volatile listings (see VOLATILE_API_METHODS)
+    are kept in memory for the current run only
+    """
+
+    def __init__(self, cache_path: Path, **kwargs):
+        super().__init__(**kwargs)
+        self.db = sqlite3.connect(cache_path, check_same_thread=False)
+        with self.db as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS api_cache("
+                "key TEXT PRIMARY KEY NOT NULL, expires REAL NOT NULL, value BLOB)"
+            )
+
+    def get(self, key, default=None):
+        if is_volatile_api_call(key):
+            return super().get(key, default)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT expires, value FROM api_cache WHERE key=?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return default
+            if row[0] < time.time():
+                self.delete(key)
+                return default
+            return pickle.loads(row[1])
+
+    def set(self, key, value, timeout=None):
+        if not is_api_success(value):
+            return
+        if is_volatile_api_call(key):
+            super().set(key, value, timeout)
+            return
+        if timeout is None:
+            timeout = self.default_timeout
+        try:
+            data = pickle.dumps(value)
+        except Exception as err:
+            logger.debug(f"cannot cache response for {key} - {err!r}")
+            return
+        with self.lock:
+            if len(self) >= self.max_entries:
+                self.cull()
+            with self.db as con:
+                con.execute(
+                    "REPLACE INTO api_cache(key, expires, value) VALUES (?, ?, ?)",
+                    (key, time.time() + timeout, data),
+                )
+
+    def delete(self, key):
+        with self.lock, self.db as con:
+            con.execute("DELETE FROM api_cache WHERE key=?", (key,))
+
+    def cull(self):
+        """ drop expired entries, and if still too many the ones expiring first """
+        with self.lock, self.db as con:
+            con.execute("DELETE FROM api_cache WHERE expires < ?", (time.time(),))
+            count = con.execute("SELECT COUNT(*) FROM api_cache").fetchone()[0]
+            if count >= self.max_entries:
+                con.execute(
+                    "DELETE FROM api_cache WHERE key IN "
+                    "(SELECT key FROM api_cache ORDER BY expires LIMIT ?)",
+                    (count // self.cull_frequency + 1,),
+                )
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM api_cache").fetchone()[0]
+
+
+def create_api_cache(cache_path: Path, persist: bool = False, **kwargs) -> CountingAPIcallsCache:
+    """ create cache for Flickr API calls, in memory unless persist is requested """
+    if persist:
+        return PersistentAPIcallsCache(cache_path, **kwargs)
+    return CountingAPIcallsCache(**kwargs)
@@ -8,28 +8,24 @@ from typing import Optional
 import os
 import time
 import json
-import base64
 import datetime
 import re
 import traceback
 from pathlib import Path
-import hashlib
 import csv
 from ratelimit import limits, sleep_and_retry  ### TODO need sleep_and_retry?
 
-from .database import PhotoNotesDB, lookup_note
+from .database import PhotoNotesDB, lookup_note_meta
 from .flickr_types import FlickrPhotoNote
 from .exceptions import PhotoNoteNotFound, NoteNotFound
 from . import utils
 from . import flickr_utils
 from . import cached_lookup
 
-from evernote.edam.type.ttypes import Note
 
 import flickr_api
 from flickr_api.objects import Person, Photo, FlickrList
 import requests
-import requests_cache  # usefulness for flickr API? looks like Flicker prenvents caching
 import fake_useragent
 
 
@@ -42,6 +38,9 @@ IMAGES_PER_PAGE = 500
 IMAGES_PER_PAGE_FIRST = 100
 
 
+# page number appended to photo url, e.g. https://www.flickr.com/photos/(blog_id)/(photo_id)/:3
+PAGENO_RE = re.compile(r':(\d+)$')
+
 LIMIT_PHOTOS_INTERVAL = 600  # 10 minutes, in seconds
 LIMIT_PHOTOS_COUNT = 500  # photos per interval 500 per 10 m => 3000 per hour
 # flickr demands to stay under 3600 queries per hour
@@ -81,26 +80,21 @@ class NoteCreator:
         self.import_path.mkdir(exist_ok=True)
 
         flickr_utils.authenticate(use_auth_session=options.use_auth_session)
-        if os.environ.get('REQUESTS_CACHE') != '1':
-            self.session = requests.session()
-        else:
-            # cache as much as we can to reduce number of API calls
-            # but useful only while debugging and repeatedly call methods for same url
-            self.session = requests_cache.CachedSession(
-                'note_creator',
-                expire_after=datetime.timedelta(days=6)
-            )
-            requests_cache.install_cache('note_creator')
-
-        self.api_cache = flickr_utils.CountingAPIcallsCache(
+        # cache as much as we can to reduce number of API calls if REQUESTS_CACHE=1
+        # but useful only while debugging and repeatedly call methods for same url
+        self.session = flickr_utils.create_session(use_cache=os.environ.get('REQUESTS_CACHE') == '1')
+
+        # cache API calls in memory, if API_CACHE=1 persist them so that reruns for same image
+        # do not hit Flickr again
+        self.api_cache = flickr_utils.create_api_cache(
+                photos_cache_dir / "flickr_api_cache.db",
+                persist=os.environ.get('API_CACHE') == '1',
                 timeout=3600 * 12,  # 12 hours
                 max_entries=1000,
         )
         # defaults are: timeout=300, max_entries=200
         # len(self.api_cache) is number of entries in cache
-        flickr_api.enable_cache(
-            self.api_cache
-        )
+        # note: enabled for flickr_api while creating a note only, see route_api_calls
 
     def pick_size(self, sizes, candidates):
         all_size_labels = set(sizes.keys())
@@ -224,21 +218,12 @@ class NoteCreator:
         photosets = []
         for context in photo.getAllContexts():
             for item in context:
+                # keep (title, href, count) tuples, only used for formatting below
                 if isinstance(item, flickr_api.objects.Photoset):
-                    photosets.append({
-                        'id': item.id,
-                        'album_title': item.title,
-                        'href': f"{item.owner.photosurl}albums/{item.id}",
-                        'count': item.count_photos
-                    })
+                    photosets.append((item.title, f"{item.owner.photosurl}albums/{item.id}", item.count_photos))
                 elif isinstance(item, flickr_api.objects.Group):
                     # .name
-                    groups.append({
-                        'id': item.id,
-                        'group_title': item.title,
-                        'href': item.url,
-                        'count': int(item.pool_count)
-                    })
+                    groups.append((item.title, item.url, int(item.pool_count)))
                 else:
                     # what else?
                     logger.debug(f"ignored")
@@ -246,13 +231,13 @@ class NoteCreator:
         self.params['albums_count'] = len(photosets)
         if photosets:
             albums_info = [ '<ul>', ]
-            for item in photosets:
+            for title, href, count in photosets:
                 albums_info.append('<li><div>')
-                item_title = utils.quote_xml(item['album_title'])
+                item_title = utils.quote_xml(title)
                 album_title = f"""<span style="color:rgb(0, 0, 0);">{item_title}</span>"""
-                count_photos = f"{item['count']:,}".replace(',', '.')
+                count_photos = f"{count:,}".replace(',', '.')
                 albums_info.append(
-                    f"""<a href="{item['href']}" rev="en_rl_none">{album_title}</a> (#={count_photos})"""
+                    f"""<a href="{href}" rev="en_rl_none">{album_title}</a> (#={count_photos})"""
                 )
                 albums_info.append('</div></li>')
             albums_info.append('</ul>')
@@ -262,15 +247,15 @@ class NoteCreator:
 
         self.params['groups_count'] = len(groups)
         if groups:
-            groups.sort(key=lambda value: value['count'])
+            groups.sort(key=lambda value: value[2])
             groups_info = ['<ul>', ]
-            for item in groups:
+            for title, href, count in groups:
                 groups_info.append('<li><div>')
-                item_title = utils.quote_xml(item['group_title'])
+                item_title = utils.quote_xml(title)
                 group_title = f"""<span style="color:rgb(0, 0, 0);">{item_title}</span>"""
-                count_photos = f"{item['count']:,}".replace(',', '.')
+                count_photos = f"{count:,}".replace(',', '.')
                 groups_info.append(
-                    f"""<a href="{item['href']}" rev="en_rl_none">{group_title}</a> (#={count_photos})"""
+                    f"""<a href="{href}" rev="en_rl_none">{group_title}</a> (#={count_photos})"""
                 )
                 groups_info.append('</div></li>')
             groups_info.append('</ul>')
@@ -335,18 +320,17 @@ class NoteCreator:
             # have photo-note in notes db, so preset tags from existing note
             note_tags.update(photo_note.note_tags.split('|'))
 
-            en_note = self.lookup_en_note(photo_note)
+            en_note_title = self.lookup_en_note_title(photo_note)
 
             # make note title visually different as it is a update for an already existing note
-            if en_note:
+            if en_note_title is not None:
                 # sometimes note title and flickr title differ (as intellectually updated)
                 # prefer / keep evernote note title
-                note_title = f"[new] {en_note.title}"
+                note_title = f"[new] {en_note_title}"
             else:
                 note_title = f"[new] {photo.title}"
 
         else:
-            en_note = None
             note_title = photo.title
 
         self.params['flickr_title'] = utils.quote_xml(photo.title)
@@ -394,11 +378,9 @@ class NoteCreator:
         self.get_location_info(photo)
         if self.params.get("location_info"):
             # append location to image title
-            location_parts = self.params.get("location_info").split(',')
-
             if not photo_note:
                 self.params['note_title'] += " | "
-                self.params['note_title'] += ",".join(location_parts)
+                self.params['note_title'] += self.params["location_info"]
 
         sizes = photo.getSizes()
         for s_key in ('Medium', 'Medium 500', 'Small'):
@@ -428,8 +410,7 @@ class NoteCreator:
             if img_file_s:
                 self.params['preview_fn'] = img_key
                 img_data_raw = img_file.read_bytes()
-                img_data = base64.b64encode(img_data_raw).decode()
-                self.params['filehash'] = hashlib.md5(img_data_raw).hexdigest()
+                img_data, self.params['filehash'] = utils.encode_resource(img_data_raw)
                 self.params['preview_width'] = s_item['width']
                 self.params['preview_height'] = s_item['height']
                 img_suffix = Path(img_key).suffix
@@ -446,16 +427,12 @@ class NoteCreator:
             logger.warning("missing image for preview")
             missing_image = self.template_file.parent / "missing_image.png"
             img_data_raw = missing_image.read_bytes()
-            self.params['filehash'] = hashlib.md5(img_data_raw).hexdigest()
-            img_data = base64.b64encode(img_data_raw).decode()
+            img_data, self.params['filehash'] = utils.encode_resource(img_data_raw)
             self.params['preview_fn'] = '-NA-'
             self.params['preview_width'] = 142
             self.params['preview_height'] = 142
             self.params['mimetype'] = "image/png"
 
-        # ensure padding
-        while len(img_data) % 4 != 0:
-            img_data += '='
         self.params['resource_data'] = img_data
 
         # extract tags
@@ -476,8 +453,8 @@ class NoteCreator:
         archive_path = Path(os.environ["PHOTO_ARCHIVE"]) if os.environ.get("PHOTO_ARCHIVE") else None
         img_key_item, s_size = self.pick_size(sizes, ("Large", "Medium"))
         if s_size:
-            key_parts = str(img_key_item).split('_')
-            archive_name = f"{user.id} {photo.id} {'_'.join(key_parts[1:])}"
+            # file name of image without leading photo id, e.g. (secret)_b.jpg
+            archive_name = f"{user.id} {photo.id} {str(img_key_item).partition('_')[2]}"
             if blog_id != user.id:
                 archive_name = f"{blog_id} {archive_name}"
             logger.info(f"image is {img_key_item} size={s_size['label']} ...")
@@ -523,6 +500,7 @@ class NoteCreator:
         if not has_error:
             # save generated enex file
             enex = utils.from_template(self.template_file, self.params)
+            # content is embedded as CDATA, so this checks the enex envelope only (title, tags, urls)
             enex2, has_error = utils.validate_content(enex.encode('utf-8'))
             if has_error:
                 enex = f"<!-- {has_error} -->\n" + enex2.decode('utf-8')
@@ -545,13 +523,13 @@ class NoteCreator:
             # we potentially get more than one - pick first
             return found[0]
 
-    def lookup_en_note(self, photo_note: FlickrPhotoNote) -> Optional[Note]:
-        """ lookup Evernote note in evernote-backup db """
+    def lookup_en_note_title(self, photo_note: FlickrPhotoNote) -> Optional[str]:
+        """ lookup title of Evernote note in evernote-backup db """
         try:
-            note = lookup_note(self.notes_db.store, photo_note.guid_note)
+            note_meta = lookup_note_meta(self.notes_db.store, photo_note.guid_note)
         except NoteNotFound:
             return None
-        return note
+        return note_meta["title"]
 
     def is_photo_url(self, url):
         return flickr_utils.is_flickr_url(url, 'photos/')
@@ -560,10 +538,10 @@ class NoteCreator:
     def create_note(self, flickr_url: str) -> bool:
         if not self.is_photo_url(flickr_url):
             raise ValueError(f"not a valid Flickr UR:: {flickr_url}")
-        if re.search(r':\d+$', flickr_url):
-            parts = flickr_url.split(':')
-            pageno = int(parts[-1])
-            flickr_url = ':'.join(parts[:-1])
+        pageno_match = PAGENO_RE.search(flickr_url)
+        if pageno_match:
+            pageno = int(pageno_match.group(1))
+            flickr_url = flickr_url[:pageno_match.start()]
             logger.info(f"create photo-note from {flickr_url} page={pageno}")
         else:
             pageno = None
@@ -589,9 +567,12 @@ class NoteCreator:
 
         ok = False
         try:
-            ok = self.create_note_for_photo(
-                flickr_url, blog_id, photo_id, enex_path, pageno
-            )
+            # route API calls through self.session and self.api_cache only while creating the note, as
+            # BlogCreator may be used in the same run with its own session and cache
+            with flickr_utils.route_api_calls(self.session, self.api_cache):
+                ok = self.create_note_for_photo(
+                    flickr_url, blog_id, photo_id, enex_path, pageno
+                )
         except Exception as err:
             error_info = f"""ERROR create-note failed
             
@@ -639,7 +620,9 @@ error details:
         if not user:
             raise ValueError(f"user not found by url={flickr_url}")
 
-        user_data.write_text(json.dumps(user.__dict__, indent=4, default=str), encoding='utf-8')
+        if self.options.debug:
+            # dump user info for examination, only when debugging
+            user_data.write_text(json.dumps(user.__dict__, indent=4, default=str), encoding='utf-8')
         # user_data_c = SimpleNamespace(**json.loads(user_data.read_text()))
         photos_count = user.photos_info.get('count') or 'NA'
         logger.info(f"user for {blog_id} is {user.id} / {user.username!r} - #={photos_count}\n")
@@ -648,7 +631,8 @@ error details:
         now = datetime.date.today().isoformat()
         page = 0
         per_page = IMAGES_PER_PAGE_FIRST
-        if self._lookup_cache.is_large_site(user):  # use max value for per_page for large site
+        large_site = self._lookup_cache.is_large_site(user)  # reused below, flag only gets set there
+        if large_site:  # use max value for per_page for large site
             per_page = IMAGES_PER_PAGE
         photos = user.getPhotos(
             page=page,
@@ -675,25 +659,26 @@ photos_info:
         # info on latest photo in blog
         latest_photo = photos[0]
         last_taken = flickr_utils.get_taken(latest_photo)
-        last_upload = datetime.datetime.fromtimestamp(int(latest_photo.dateuploaded)).isoformat()[:10]
-
-        for pos, photo in enumerate(photos):
-            attrs = photo.__dict__.keys()
-            # if photo.loaded is False:
-            #     # will triggering load when acceesing attributes
-            #     # photo.loaded = True # flickr_api.flickrerrors.FlickrError: Readonly attribute
-            #     logger.debug(f"#{pos} unloaded Photo id={photo.id} - have {attrs}")
-            dateuploaded = ''
-            if 'dateuploaded' in attrs:
-                dateuploaded = datetime.datetime.fromtimestamp(int(photo.dateuploaded)).isoformat()[0:]
-            else:
-                dateuploaded = '(not loaded/unknown)'
-            logger.debug(f"photo id={photo.id} upload={dateuploaded} title={photo.title!r}")
+        last_upload = flickr_utils.get_uploaded(latest_photo)
+
+        # listing photos formats a timestamp per photo (up to per_page), so only when it gets logged
+        if logger.isEnabledFor(logging.DEBUG):
+            for pos, photo in enumerate(photos):
+                attrs = photo.__dict__
+                # if photo.loaded is False:
+                #     # will triggering load when acceesing attributes
+                #     # photo.loaded = True # flickr_api.flickrerrors.FlickrError: Readonly attribute
+                #     logger.debug(f"#{pos} unloaded Photo id={photo.id} - have {attrs}")
+                if 'dateuploaded' in attrs:
+                    dateuploaded = datetime.datetime.fromtimestamp(int(photo.dateuploaded)).isoformat()
+                else:
+                    dateuploaded = '(not loaded/unknown)'
+                logger.debug(f"photo id={photo.id} upload={dateuploaded} title={photo.title!r}")
 
         # cache latest photos to detect updates
         new_pos = self._lookup_cache.update_cache(user, photos)
         if new_pos < 0:
-            if not self._lookup_cache.is_large_site(user):
+            if not large_site:
                 # have more new photos than what cache can hold - increase it
                 self._lookup_cache.drop_cache(user)
                 self._lookup_cache.flag_large_site(user)
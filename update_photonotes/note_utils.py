@@ -38,10 +38,14 @@ def log_format_note(note):
 
 def extract_enex_content(enex_path):
     assert enex_path.is_file(), f"missing enex path {enex_path}"
-    enex_xml = etree.fromstring(enex_path.read_text(encoding='utf-8').encode('utf-8'))
-    content = enex_xml.xpath(".//content")
+    # stream enex, it may hold large resources (base64 image data) that are dropped once parsed
+    content = []
+    for _, elem in etree.iterparse(str(enex_path), tag=('content', 'resource')):
+        if elem.tag == 'content':
+            content.append(elem.text)
+        elem.clear()
     assert len(content) == 1, "missing content, not found"
-    content_xml = etree.fromstring(content[0].text.strip().encode('utf-8'))
+    content_xml = etree.fromstring(content[0].strip().encode('utf-8'))
     # for better readability / to support manual examination, pretty-print XML
     content_pp = etree.tostring(content_xml, pretty_print=True).decode('utf-8')
     content_path = enex_path.with_suffix('.xml')
@@ -3,6 +3,7 @@ Encapsulates update handling
 """
 
 import os
+import re
 import datetime
 from pathlib import Path
 from typing import Optional
@@ -14,7 +15,6 @@ from evernote_backup.note_exporter_util import SafePath
 from evernote.edam.type.ttypes import Note
 
 
-from .flickr_utils import is_flickr_url
 from .conversion import get_note_content
 from .flickr_types import FlickrPhotoNote, FlickrDate
 from .database import PhotoNotesDB, lookup_note
@@ -39,6 +39,45 @@ NO_SEE_INFO = (
     '-NA-',
 )
 
+# album and gallery links in photo notes, e.g.
+# 'https://www.flickr.com/photos/(blog_id))/sets/(set_id))'
+# 'https://www.flickr.com/photos/(blog_id)/albums/(album_id)'
+# 'https://www.flickr.com/photos/(blog_id)/galleries/(gallery_id)/'
+COLLECTION_LINK_RE = re.compile(r'/(sets|albums|galleries)/')
+# standard form, having the collection type as 6th path element as in the examples above
+STANDARD_COLLECTION_LINK_RE = re.compile(r'[^/]*/[^/]*/[^/]*/[^/]*/[^/]*/(sets|albums|galleries)(/|$)')
+
+# size suffix of image file name in see-info, e.g. 3k, 4k, 6k, o (original), k, h, b (large)
+SIZE_SUFFIX_RE = re.compile(r'\d+k|[okhb]')
+
+# parser for note content, reused for all notes (updater runs single-threaded)
+# note: keep whitespace-only text, as see-info text is joined from all text nodes;
+# lxml defaults already refuse huge trees and network access, entity handling is kept as is
+NOTE_PARSER = etree.XMLParser()
+
+# precompiled xpath expressions, evaluated for every note analyzed
+SEE_INFO_XPATH = etree.XPath('//*[substring-after(text(), "see:")]')  # div or span
+# any image thumbnail (en-media) before node, stops at first one found instead of collecting all
+HAS_MEDIA_BEFORE_XPATH = etree.XPath("boolean(preceding::en-media[1])")
+
+# flickr links in photo notes needing no further handling
+IGNORED_FLICKR_PATHS = (
+    'search/',  # location info, e.g. 'https://www.flickr.com/search/?lat=...'
+    'groups',  # e.g. 'https://www.flickr.com/groups/(groupid))/'
+    'map/',  # flickr map url, e.g. 'https://www.flickr.com/map/?fLat=...&fLon=...8...'
+    'people/',  # e.g. 'https://www.flickr.com/people/(blogid))/' - TODO extract link to photo blog, check blogid
+    'explore/',  # e.g. https://www.flickr.com/explore/2022/10/03
+    'redirect?url=',  # e.g. 'https://www.flickr.com/redirect?url=https://www.instagram.com/(userid)'
+)
+# same prefixes as is_flickr_url checks, as tuple for a single str.startswith per link
+IGNORED_FLICKR_URLS = tuple(
+    f'{host}{path}' for path in IGNORED_FLICKR_PATHS for host in ('https://www.flickr.com/', 'https://flickr.com/')
+)
+
+# number of flickr_image rows to collect before writing them in one transaction
+IMAGE_UPDATE_BATCH = 500
+
+
 class NotesUpdater:
 
     def __init__(self, notes_db: PhotoNotesDB, options):
@@ -49,6 +88,7 @@ class NotesUpdater:
         self.count = None
         self.pos = 0
         self.warnings = {}  # categorized list of warnings
+        self._pending_images = []  # flickr_image updates not yet written, see _flush_images
 
     def update(self, notebook: str) -> None:
         self.count = 0
@@ -68,22 +108,36 @@ class NotesUpdater:
         self.pos = 0
         processed = []
         notebooks = tuple(self.notes_db.store.notebooks.iter_notebooks())
-        for nb in notebooks:
-            if notebook not in("*", "all") and nb.name != notebook:
-                logger.debug(f"skip notebook: {nb.name}")
-                continue
-            processed.append(nb.name)
-            self._update_notes(nb, export_enex)
+        try:
+            for nb in notebooks:
+                if notebook not in("*", "all") and nb.name != notebook:
+                    logger.debug(f"skip notebook: {nb.name}")
+                    continue
+                processed.append(nb.name)
+                self._update_notes(nb, export_enex)
+        finally:
+            # also when stopped early, e.g. on reaching notes limit
+            self._flush_images()
         logger.info(f"updated notebook: {processed} ")
         return
 
+    def _flush_images(self) -> None:
+        """ write collected flickr_image updates """
+        if not self._pending_images:
+            return
+        self.notes_db.flickrimages.update_images(
+            self._pending_images,
+            log_changes=os.getenv("DEBUG") == '1'
+        )
+        self._pending_images = []
+
     def _need_update_blog(self, blog_note) -> bool:
         """ verify content of blog note """
         content = get_note_content(blog_note.content)
         try:
-            xml = etree.fromstring(content)
-            for anchor in xml.xpath('//a'):
-                href = anchor.attrib.get("href")
+            xml = etree.fromstring(content, NOTE_PARSER)
+            for anchor in xml.iter('a'):
+                href = anchor.get("href")
                 if 'flickr.com' not in href:
                     continue
                 if href.startswith(FLICKR_PHOTO_URL):
@@ -139,7 +193,7 @@ class NotesUpdater:
 
             else:
                 # assume stacked image without highlight
-                found = div.xpath(".//text()")
+                found = list(div.itertext())
                 if not found:
                     # TODO examine
                     found = div.text or '(see-info missing)'
@@ -155,7 +209,7 @@ class NotesUpdater:
         if found.startswith('see:'):
             found = found[4:].strip()
         if '|' in found:
-            found = found.split('|')[0].strip()
+            found = found.partition('|')[0].strip()
         if found in ('(not archived)', '-NA-'):
             return None, None
         if not highlighted:
@@ -179,10 +233,9 @@ class NotesUpdater:
             if node is None:
                 cleanup_required = "failed to find main image link for photo note"
                 break
-            anchor = node.xpath('a')
-            if anchor:
-                assert len(anchor) == 1
-                return node, anchor[0].attrib.get("href")
+            anchor = node.find('a')
+            if anchor is not None:
+                return node, anchor.get("href")
         return None, None
 
     def _extract_see(self, xml: etree.Element, note: Note):
@@ -194,17 +247,23 @@ class NotesUpdater:
             # is_highlight = node.xpath("span", _style="--en-highlight:yellow")  # produces false positives
             # is_highlight = len(node.xpath("//span[contains(@style, '--en-highlight:yellow')]")) > 0  # dito
             # avoid false positives
-            frag_text = etree.tostring(node).decode('utf-8')
-            if "--en-highlight:yellow" in frag_text:
-                if frag_text.count("--en-highlight:yellow") != 1:
+            # count highlights in style of node and its descendants, without serializing node
+            highlights = sum((el.get('style') or '').count("--en-highlight:yellow")
+                             for el in node.iter(etree.Element))
+            if highlights:
+                if highlights != 1:
+                    frag_text = etree.tostring(node, encoding='unicode')
                     logger.warn(f"found multiple highlight sections in: {frag_text}")
                     self.add_warning("cleanup required", "multiple highlights in see-info")
                 return True
             return False
 
         def get_see_text(node):
-            node_info = etree.tostring(node)
-            see_info = ' '.join([f.strip() for f in node.xpath(".//text()")])
+            if len(node):
+                see_info = ' '.join([f.strip() for f in node.itertext()])
+            else:
+                # common case, see-info without markup
+                see_info = (node.text or '').strip()
             see_info = see_info[4:].strip()   # strip see: prefix
 
             is_highlight = get_highlight(node)
@@ -212,20 +271,21 @@ class NotesUpdater:
                 # value = ' '.join([f.strip() for f in is_highlight[0].xpath(".//text()")])
                 value = see_info
                 if '|' in value:
-                    value = value.split('|')[0].strip()
+                    value = value.partition('|')[0].strip()
                 if not value:
+                    node_info = etree.tostring(node, encoding='unicode')
                     logger.warning(f"ignore highlight with only whitespace in {node_info}")
                     return ""
             else:
                 # stacked see-info, prepend plus to indicate
                 if '|' in see_info:
-                    see_info = see_info.split('|')[0].strip()
+                    see_info = see_info.partition('|')[0].strip()
                 if not see_info:
                     see_info = " (no text)"
                 value = '+' + see_info
             return value
 
-        see_divs = xml.xpath('//*[substring-after(text(), "see:")]')  # div or span
+        see_divs = SEE_INFO_XPATH(xml)
         if not see_divs:
             self.add_warning("cleanup required", "missing see-info")
             return None
@@ -417,21 +477,20 @@ found see:
         content = get_note_content(note.en_note.content)
         try:
             # extract see:
-            xml = etree.fromstring(content)
+            xml = etree.fromstring(content, NOTE_PARSER)
             result['see'] = self._extract_see(xml, note)
             link_info = None
             image_anchors = []
             links = {}
-            for anchor in xml.xpath('//a'):
-                href = anchor.attrib.get("href")
+            for anchor in xml.iter('a'):
+                href = anchor.get("href")
                 if not href or 'flickr.com' not in href:
                     continue
                 if href.startswith("https://api.flickr.com/photos/tags"):
                     continue
                 if href.startswith('http://www.flickr.com/'):
                     # differentiate if url from photo author (in description) or own
-                    media_before = anchor.xpath("preceding::en-media")
-                    if not media_before and self.options.warn_href_http:
+                    if self.options.warn_href_http and not HAS_MEDIA_BEFORE_XPATH(anchor):
                         self.add_warning("found non-https link", anchor.text, href)
                     href = 'https://www.flickr.com' + href[21:]
                 if href.startswith('https://secure.flickr.com/'):
@@ -439,20 +498,12 @@ found see:
                     href = 'https://www.flickr.com' + href[25:]
                 if href.startswith('https://www.flickr.com/photos/tags/'):
                     continue
-                if '/sets/' in href:
-                    # e.g. 'https://www.flickr.com/photos/(blog_id))/sets/(set_id))'
-                    if href.split('/')[5] != 'sets':
-                        logger.warning(f"{self.pos}| ignore non-standard album link {href}")
-                    continue
-                if '/albums/' in href:
-                    # e.g. 'https://www.flickr.com/photos/(blog_id)/albums/(album_id)'
-                    if href.split('/')[5] != 'albums':
-                        logger.warning(f"{self.pos}| ignore non-standard album link {href}")
-                    continue
-                if '/galleries/' in href:
-                    # e.g. 'https://www.flickr.com/photos/(blog_id)/galleries/(gallery_id)/'
-                    if href.split('/')[5] != 'galleries':
-                        logger.warning(f"{self.pos}| ignore non-standard galleries link {href}")
+                collection = COLLECTION_LINK_RE.search(href)
+                if collection:
+                    # album or gallery link, see COLLECTION_LINK_RE
+                    if not STANDARD_COLLECTION_LINK_RE.match(href):
+                        kind = 'galleries' if collection.group(1) == 'galleries' else 'album'
+                        logger.warning(f"{self.pos}| ignore non-standard {kind} link {href}")
                     continue
                 if href.startswith("https://www.flickr.com/photos/"):
                     # 'href': 'https://www.flickr.com/photos/27297062@N02/51089206529/in/pool-inexplore/',
@@ -465,8 +516,7 @@ found see:
                         continue
                     else:
                         # check if before or after image thumbnail (en-media element)
-                        media_before = anchor.xpath("preceding::en-media")
-                        before_thumbnail = not media_before
+                        before_thumbnail = not HAS_MEDIA_BEFORE_XPATH(anchor)
                         image_anchors.append(anchor)
 
                     link_info = candidate
@@ -497,31 +547,8 @@ found see:
                         # may have added
                         break
 
-                elif is_flickr_url(href, 'search/'):
-                    # location info, e.g. 'https://www.flickr.com/search/?lat=...'
-                    pass
-
-                elif is_flickr_url(href, 'groups'):
-                    pass
-
-                elif is_flickr_url(href, 'map/'):
-                    # flickr map url, e.g. 'https://www.flickr.com/map/?fLat=...&fLon=...8...'
-                    pass
-
-                elif is_flickr_url(href, 'groups/'):
-                    # e.g. 'https://www.flickr.com/groups/(groupid))/'
-                    pass
-
-                elif is_flickr_url(href, 'people/'):
-                    # e.g. 'https://www.flickr.com/people/(blogid))/'
-                    pass  # TODL extract link to photo blog - but need to check blogid to match note
-
-                elif is_flickr_url(href, 'explore/'):
-                    # e.g. https://www.flickr.com/explore/2022/10/03
-                    pass
-
-                elif is_flickr_url(href, 'redirect?url='):
-                    # e.g. 'https://www.flickr.com/redirect?url=https://www.instagram.com/(userid)'
+                elif href.startswith(IGNORED_FLICKR_URLS):
+                    # location info, groups, map, people, explore and redirect links, see IGNORED_FLICKR_PATHS
                     pass
 
                 elif href == 'https://www.flickr.com/account/upgrade/pro':
@@ -592,6 +619,9 @@ found see:
             logger.info(f"updating notebook {notebook.name} ...")
         store = self.notes_db.store
         notes_source = store.notes.iter_notes(notebook.guid)
+        # options constant while iterating notes, so look them up once
+        tag_name = self.options.tag_name
+        note_title = self.options.note_title
 
         for note in notes_source:
             assert isinstance(note, Note), "expect note instance"
@@ -606,7 +636,7 @@ found see:
                 logger.debug(f'skip inaccessible note: {note2}')
                 continue
 
-            if self.options.tag_name and self.options.tag_name not in note.tagNames:
+            if tag_name and tag_name not in note.tagNames:
                 logger.info(f"skip note {self.pos} not having desired tag name")
                 continue
 
@@ -633,7 +663,7 @@ found see:
                     continue
 
                 # for debugging, it is somethimes useful to be able to pick a photo-note by title
-                if self.options.note_title and self.options.note_title not in note.title:
+                if note_title and note_title not in note.title:
                     continue
                 handler(note2, export_enex)
 
@@ -661,7 +691,6 @@ found see:
 
     def _update_flickr_image(self, note: Note2, export_enex: bool) -> None:
         """ examine and update photo-note """
-        debug = os.getenv("DEBUG")
         self.warnings = {}  # drop warnings from previous notes
 
         pnote_info = self._analyze_photo_note(note)
@@ -720,21 +749,16 @@ found see:
             # this is primary image, update stacked images, too
             photo_note.entry_updated = FlickrDate.today()  # set after update
 
-        # update flickr_image in SQLite db
+        # update flickr_image in SQLite db, collected to write them in batches
+        photo_note = pnote_info['photo_note']
         if primary_link:
-            self.notes_db.flickrimages.update_image(
-                pnote_info['photo_note'], primary_link,
-                is_primary=True,
-                log_changes=debug
-            )
+            self._pending_images.append((photo_note, primary_link, True))
         for image_key in pnote_info['all']:
             if not primary_link or image_key != primary_link['image_key']:
                 stacked_link = pnote_info['all'][image_key]
-                self.notes_db.flickrimages.update_image(
-                    pnote_info['photo_note'], stacked_link,
-                    is_primary = False,
-                    log_changes=debug
-                )
+                self._pending_images.append((photo_note, stacked_link, False))
+        if len(self._pending_images) >= IMAGE_UPDATE_BATCH:
+            self._flush_images()
 
 
         # TODO export enex only if note requires update in Evernote
@@ -774,7 +798,7 @@ found see:
 
             if '|' in see:
                 logger.debug(f"{self.pos}| truncate see-info at slash: {see}")
-                see = see.split('|')[0].strip()
+                see = see.partition('|')[0].strip()
             see_parts = see.split('.')
             if len(see_parts) > 1:
                 if see_parts[-1] == 'crdownload':
@@ -789,11 +813,9 @@ found see:
                 elif see_filetype not in ('jpeg', 'jpg', 'mp4', 'video'):
                     logger.warning(f"unexpected suffix in see-info: {see}")
                     photo_note.add_cleanup("{self.pos}| unrecognized filetype suffix in see-info")
-                fn_parts = see_parts[-2].split('_')
-                while fn_parts and not fn_parts[-1]:
-                    # drop trailing underscore, e.g. in 'jeffstamer 52148827555 _Tower of Terror_.jpeg'
-                    # or 'petrapetruta 50627873916 About time___.jpeg'
-                    fn_parts = fn_parts[:-1]
+                # drop trailing underscore, e.g. in 'jeffstamer 52148827555 _Tower of Terror_.jpeg'
+                # or 'petrapetruta 50627873916 About time___.jpeg'
+                fn_parts = see_parts[-2].rstrip('_').split('_')
                 if len(fn_parts) >= 3 and is_size_suffix(fn_parts[-1]):
                     # len restriction to avoid false positives, see e.g.
                     # '_ The Vikings _ 137473925@N08 41831720970.jpeg'
@@ -813,16 +835,8 @@ found see:
 
 
 def is_size_suffix(value):
-    if value.endswith('k') and value[:-1].isdigit():
-        # 3k, 4k, 6k, ...
-        return True
-    if value == 'o':
-        return True
-    if value in ('k', 'h', 'b',):  # large
-        return True
-    if value in ('?', ):
-        return False
-    return False
+    # 3k, 4k, 6k, ..., original or large (k, h, b)
+    return SIZE_SUFFIX_RE.fullmatch(value) is not None
 
 def _write_export_file(
     file_path: Path, note: Note
@@ -4,6 +4,9 @@ collection of utility functions
 
 import os
 import re
+import base64
+import hashlib
+import functools
 from pathlib import Path
 
 import dotenv
@@ -12,6 +15,16 @@ from lxml import etree
 import logging
 logger = logging.getLogger('utils')
 
+# mimetype by image file suffix, see get_mimetype
+MIMETYPES = {
+    '.jpg': "image/jpeg",
+    '.jpeg': "image/jpeg",
+    '.png': "image/png",
+}
+
+# placeholder in templates, e.g. ${note_title}
+PLACEHOLDER_RE = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}')
+
 
 def load_dotenv():
     """ get credentials, load from .env file """
@@ -79,21 +92,34 @@ def get_safe_property(obj, name, default=None):
     return default
 
 
-def from_template(template, params, encoding='utf-8'):
-    data = template.read_text(encoding=encoding)
-    for key in params:
-        data = data.replace(f'${{{key}}}', str(params[key]))
+@functools.lru_cache(maxsize=8)
+def _load_template(path: str, mtime: float, encoding: str) -> str:
+    """ read template once per run; mtime is part of key to reload when template got edited """
+    return Path(path).read_text(encoding=encoding)
 
-    match = re.search(r'\${(.*?)}', data)
-    if match:
-        logger.warning("detected placeholders in template not replaced: %s" % match.group(1))
+
+def from_template(template, params, encoding='utf-8'):
+    data = _load_template(str(template), template.stat().st_mtime, encoding)
+    missing = []
+
+    def substitute(match):
+        key = match.group(1)
+        if key not in params:
+            missing.append(key)
+            return match.group(0)
+        return str(params[key])
+
+    # substitute all placeholders in a single pass
+    data = PLACEHOLDER_RE.sub(substitute, data)
+    if missing:
+        logger.warning("detected placeholders in template not replaced: %s" % ", ".join(missing))
     return data
 
 
 def validate_content(content: str) -> tuple:
-    """ validate and prettyprint content to ensure evernote can import it """
+    """ check content is well-formed XML to ensure evernote can import it, content is returned unchanged """
     try:
-        xml = etree.fromstring(content)
+        etree.fromstring(content)
         has_error = ""
     except Exception as err:
         logger.error(f"failed to load content as well-formed XML - {err!r}")
@@ -101,18 +127,30 @@ def validate_content(content: str) -> tuple:
     return content, has_error
 
 
+@functools.lru_cache(maxsize=8)
+def _all_tags_xpath(tag_name: str) -> etree.XPath:
+    """ compiled xpath selecting all elements with given tag, compiled once per tag """
+    return etree.XPath(f"//{tag_name}")
+
+
 def drop_empty_tags(tree, tag_name):
     """ drop elements (e.g div's) without content """
-    for child in tree.xpath(f"//{tag_name}"):
+    for child in _all_tags_xpath(tag_name)(tree):
         if not child.text:
             child.getparent().remove(child)
 
 
 def get_mimetype(img_suffix: str) -> str:
-    if img_suffix in ('.jpg', '.jpeg',):
-        return "image/jpeg"
-    elif img_suffix in ('.png',):
-        return "image/png"
-    else:  # what else?
+    mimetype = MIMETYPES.get(img_suffix)
+    if mimetype is None:  # what else?
         logger.warning(f"detected unknown image suffix {img_suffix}")
         return f"image/{img_suffix}"
+    return mimetype
+
+
+def encode_resource(data: bytes) -> tuple:
+    """ get base64 encoded resource data and its hash for en-media element """
+    # note: Evernote expects MD5 of resource data as hash, so cannot use a faster hash
+    filehash = hashlib.md5(data, usedforsecurity=False).hexdigest()
+    # b64encode output is always padded to a multiple of 4
+    return base64.b64encode(data).decode(), filehash